@@ -3,11 +3,19 @@ import py4web
 
 assert py4web.check_compatible("0.1.20190709.1")
 
+# the phases of the startup are timed (see startup.py)
+from . import startup
+from . import common
+
 # by importing db you expose it to the _dashboard/dbadmin
-from .models import db
+with startup.phase('models'):
+    from .models import db
 
 # by importing controllers you expose the actions defined in it
-from . import controllers
+with startup.phase('controllers'):
+    from . import controllers
+
+startup.finish()
 
 # optional parameters
 __version__ = "0.0.0"
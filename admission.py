@@ -0,0 +1,321 @@
+"""
+This file implements the admission control of the payments.
+
+During a flash sale, hundreds of customers pay at the same moment for the
+same few products.  Processed all together, they queue for the product rows
+and for the single SQLite writer, and each holds a server thread while it
+waits for the payment gateway: latencies grow until every request times
+out, and the server does work for customers who have already given up.
+The pay action therefore goes through a gate, in each process:
+
+- at most ADMISSION_MAX_ACTIVE payments are processed at once, and at most
+  ADMISSION_MAX_PER_PRODUCT of them for the same product;
+- the others get a ticket in a FIFO waiting room of ADMISSION_QUEUE_SIZE
+  places, and poll pay with it every ADMISSION_POLL_SECONDS (see
+  static/js/index.js).  When there is room, the tickets at the head of the
+  waiting room, which poll more often, enter as they poll; tickets that are not polled for
+  ADMISSION_TICKET_SECONDS are dropped;
+- when the waiting room is full, payments are turned away at once.
+
+The stock counter keeps the quantities of the products, as read by pay and
+checkout and decreased by the reservations of this process.  While a count
+is recent (SOLD_OUT_SECONDS), carts that it cannot cover are rejected as
+sold out without touching the database.  Stock given back by this process
+makes the counts of its products forgotten at once; that given back by
+other processes, or by edits, is seen when the counts expire.
+
+The waiting room is in the memory of each process: with several processes,
+the polls of a ticket must reach the process that issued it.  The ticket
+ids start with the id of their process, and the pay action sets the cookie
+<app name>_gate to it, for the load balancer to route on (e.g., with nginx,
+"hash $cookie_vue_shop_gate consistent;").  A poll that reaches another
+process anyway is neither admitted there nor given a new ticket, which
+would break the FIFO order: the customer keeps their ticket, and polls
+again soon.  Such polls are counted in the metrics as misrouted.
+
+simulate() shows the effect of the gate on a model of the pay action; from
+the command line:
+
+    py4web call apps vue_shop.admission.simulate --args '{"load": 10}'
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .settings import (ADMISSION_MAX_ACTIVE, ADMISSION_MAX_PER_PRODUCT, ADMISSION_QUEUE_SIZE,
+                       ADMISSION_POLL_SECONDS, ADMISSION_TICKET_SECONDS, SOLD_OUT_SECONDS)
+
+ADMITTED, QUEUED, BUSY = 'admitted', 'queued', 'busy'
+
+# Seconds over which the payments finished are counted, for the window.
+WINDOW_SECONDS = 5
+
+# The id of this process, which starts the ids of its tickets.
+PROCESS_ID = uuid.uuid4().hex[:12]
+
+
+class Ticket:
+    """A place in the waiting room."""
+
+    def __init__(self, now):
+        self.id = '%s-%s' % (PROCESS_ID, uuid.uuid4().hex)
+        self.seen = now
+
+
+def ticket_process(ticket_id):
+    """Returns the id of the process that issued a ticket."""
+    return ticket_id.partition('-')[0]
+
+
+class Gate:
+    """Limits the payments processed at once, overall and per product, and
+    keeps the others in a FIFO waiting room."""
+
+    def __init__(self, max_active, max_per_product=None, queue_size=0,
+                 poll_seconds=1, ticket_seconds=10):
+        self.max_active = max_active
+        self.max_per_product = max_per_product or max_active
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.ticket_seconds = ticket_seconds
+        self.lock = threading.Lock()
+        self.active = 0
+        self.per_product = collections.Counter()
+        self.queue = collections.OrderedDict()  # Ticket id -> Ticket, oldest first.
+        self.finished = collections.deque()  # When the last payments finished.
+        self.swept = 0
+        self.stats = collections.Counter()
+
+    def _fits(self, product_ids):
+        if not self.max_active:
+            return True  # No admission control.
+        return self.active < self.max_active and all(
+            self.per_product[p] < self.max_per_product for p in product_ids)
+
+    def _take(self, product_ids):
+        self.active += 1
+        for p in product_ids:
+            self.per_product[p] += 1
+
+    def _sweep(self, now):
+        """Drops the tickets that are no longer polled."""
+        if now - self.swept < 1:
+            return
+        self.swept = now
+        while self.finished and now - self.finished[0] > WINDOW_SECONDS:
+            self.finished.popleft()
+        for t in list(self.queue.values()):
+            if now - t.seen > self.ticket_seconds:
+                del self.queue[t.id]
+                self.stats['expired'] += 1
+
+    def _position(self, ticket, now):
+        """The position of the ticket among those still polled."""
+        position = 1
+        for t in self.queue.values():
+            if t is ticket:
+                break
+            if now - t.seen < 2 * self.poll_seconds:
+                position += 1
+        return position
+
+    def window(self):
+        """The number of tickets, at the head of the waiting room, that may
+        enter when there is room.  Places are not kept for the first ticket
+        until it polls again: that would leave them empty for up to a poll
+        interval.  Instead, the tickets in the window poll often, and may
+        take the places, whichever polls first; the window holds the
+        tickets that would be served in two poll intervals."""
+        rate = len(self.finished) / WINDOW_SECONDS
+        return max(self.max_active, int(2 * rate * self.poll_seconds + 0.5))
+
+    def retry_after(self, position):
+        """Seconds after which the ticket at position should poll again: a
+        quarter of the poll interval in the window, the poll interval
+        beyond.  The jitter spreads the polls of the customers who arrived
+        together."""
+        if position is None or position <= self.window():
+            seconds = self.poll_seconds / 4
+        else:
+            seconds = self.poll_seconds
+        return round(seconds * random.uniform(0.5, 1.5), 2)
+
+    def enter(self, product_ids, ticket_id=None):
+        """Asks to process a payment for the products.  Returns the status,
+        ADMITTED, QUEUED or BUSY, the ticket id, and the position in the
+        waiting room (None if the ticket is of another process).  Once
+        ADMITTED, call leave() when done."""
+        product_ids = sorted(set(product_ids))
+        now = time.monotonic()
+        with self.lock:
+            self._sweep(now)
+            if ticket_id and ticket_process(ticket_id) != PROCESS_ID:
+                self.stats['misrouted'] += 1
+                return QUEUED, ticket_id, None
+            ticket = self.queue.get(ticket_id) if ticket_id else None
+            if ticket is not None:
+                position = self._position(ticket, now)
+                ticket.seen = now
+                if position <= self.window() and self._fits(product_ids):
+                    del self.queue[ticket.id]
+                    self._take(product_ids)
+                    self.stats['admitted_from_queue'] += 1
+                    return ADMITTED, None, 0
+                return QUEUED, ticket.id, position
+            # Newcomers do not overtake the waiting room.
+            if not self.queue and self._fits(product_ids):
+                self._take(product_ids)
+                self.stats['admitted'] += 1
+                return ADMITTED, None, 0
+            if len(self.queue) >= self.queue_size:
+                self.stats['busy'] += 1
+                return BUSY, None, None
+            ticket = Ticket(now)
+            self.queue[ticket.id] = ticket
+            self.stats['queued'] += 1
+            return QUEUED, ticket.id, len(self.queue)
+
+    def leave(self, product_ids):
+        """Frees the place of a payment admitted for the products."""
+        with self.lock:
+            self.active -= 1
+            for p in set(product_ids):
+                self.per_product[p] -= 1
+                if self.per_product[p] <= 0:
+                    del self.per_product[p]
+            self.finished.append(time.monotonic())
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, active=self.active, waiting=len(self.queue))
+
+
+class StockCounter:
+    """The recently read stock of the products, to turn away the carts that
+    cannot be served without reading the database."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.known = {}  # Product id -> (quantity, when it was read).
+
+    def update(self, quantities):
+        """Records a dictionary from product id to quantity just read."""
+        now = time.monotonic()
+        with self.lock:
+            for product_id, n in quantities.items():
+                self.known[product_id] = (n or 0, now)
+
+    def take(self, wanted):
+        """Decreases the counts of the quantities just reserved."""
+        with self.lock:
+            for product_id, n in wanted.items():
+                if product_id in self.known:
+                    quantity, read = self.known[product_id]
+                    self.known[product_id] = (max(0, quantity - n), read)
+
+    def forget(self, product_ids):
+        with self.lock:
+            for product_id in product_ids:
+                self.known.pop(product_id, None)
+
+    def covers(self, wanted):
+        """Tells if the cart may be served: False only if a recent count
+        says that a product is short."""
+        now = time.monotonic()
+        with self.lock:
+            for product_id, n in wanted.items():
+                quantity, read = self.known.get(product_id, (None, 0))
+                if quantity is not None and now - read < self.ttl and quantity < n:
+                    return False
+        return True
+
+
+gate = Gate(ADMISSION_MAX_ACTIVE, ADMISSION_MAX_PER_PRODUCT, ADMISSION_QUEUE_SIZE,
+            poll_seconds=ADMISSION_POLL_SECONDS,
+            ticket_seconds=ADMISSION_TICKET_SECONDS)
+stock_counter = StockCounter(SOLD_OUT_SECONDS)
+
+
+def simulate(load=10, seconds=20, threads=10, db_seconds=0.01, gateway_seconds=0.2,
+             patience=5, gated=None):
+    """Simulates a flash sale at load times the capacity of a process, with
+    and without the gate, and prints and returns, for each, the payments
+    completed per second, overall and by time of arrival, and their
+    latency.
+
+    The model of a process has `threads` server threads.  A payment holds
+    the single database writer for db_seconds, and then waits
+    gateway_seconds for the gateway; requests beyond the free threads
+    wait for one.  Customers arrive at a constant rate, and give up after
+    `patience` seconds: a payment that completes later is wasted work.
+    The waiting room holds the customers that can be served within half
+    their patience."""
+    capacity = min(threads / (db_seconds + gateway_seconds), 1 / db_seconds)
+    rate = load * capacity
+    results = {}
+    for name in (['gated', 'ungated'] if gated is None else ['gated' if gated else 'ungated']):
+        g = Gate(max(1, threads - 2), queue_size=int(capacity * patience / 2),
+                 poll_seconds=ADMISSION_POLL_SECONDS,
+                 ticket_seconds=ADMISSION_TICKET_SECONDS) if name == 'gated' else None
+        writer = threading.Lock()
+        lock = threading.Lock()
+        done, wasted, busy = [], [0], [0]
+        # Payments completed in time, by period of arrival.
+        period = max(1, seconds // 5)
+        periods = [0] * (int(seconds // period) + 1)
+        server = ThreadPoolExecutor(max_workers=threads)
+
+        def pay(arrived, ticket=None):
+            if g is not None:
+                status, ticket, position = g.enter([1], ticket)
+                if status == BUSY:
+                    with lock:
+                        busy[0] += 1
+                    return
+                if status == QUEUED:
+                    if time.time() - arrived < patience:
+                        # The customer polls again.
+                        threading.Timer(g.retry_after(position), lambda: server.submit(
+                            pay, arrived, ticket)).start()
+                    return
+            try:
+                with writer:
+                    time.sleep(db_seconds)
+                time.sleep(gateway_seconds)
+            finally:
+                if g is not None:
+                    g.leave([1])
+            latency = time.time() - arrived
+            with lock:
+                if latency <= patience:
+                    done.append(latency)
+                    periods[int((arrived - t0) / period)] += 1
+                else:
+                    wasted[0] += 1
+
+        t0 = time.time()
+        n = 0
+        while time.time() - t0 < seconds:
+            n += 1
+            server.submit(pay, time.time())
+            time.sleep(max(0, t0 + n / rate - time.time()))
+        # Waits for the customers still within their patience.
+        time.sleep(patience + ADMISSION_POLL_SECONDS)
+        server.shutdown(wait=False, cancel_futures=True)
+        done.sort()
+        pick = lambda p: round(1000 * done[min(len(done) - 1, int(p * len(done)))], 1) if done else None
+        results[name] = dict(
+            arrived=n, completed=len(done), completed_per_second=round(len(done) / seconds, 1),
+            wasted=wasted[0], turned_away=busy[0],
+            gave_up=n - len(done) - wasted[0] - busy[0],
+            p50_ms=pick(0.5), p99_ms=pick(0.99),
+            completed_per_second_by_arrival=[round(n / period, 1) for n in periods[:-1]])
+    results['capacity_per_second'] = round(capacity, 1)
+    print(json.dumps(results, indent=2))
+    return results
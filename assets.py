@@ -0,0 +1,194 @@
+"""
+This file implements the static asset pipeline.
+
+The JS and CSS that the pages load are grouped in the BUNDLES below.
+build() concatenates the files of each bundle, minifies them (with rjsmin
+and rcssmin, when installed), and writes the result to ASSET_FOLDER under
+a name that contains the hash of its content, together with .gz and (with
+the brotli package) .br versions, and a manifest from bundle to file name.
+As the content of a file name never changes, the asset action serves the
+bundles with immutable cache headers, and in the precompressed encoding
+the browser accepts.
+
+The bundles are built at startup when the manifest is missing or older
+than a source file; they can also be built at deploy time with:
+
+    py4web call apps vue_shop.assets.build
+
+The templates load the bundles with [[=assets.tags('base.css')]], which,
+with ASSET_BUNDLES = False, loads the source files one by one instead.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import sys
+
+from py4web import URL
+from py4web.core import Fixture
+from yatl.helpers import XML
+
+from .settings import APP_NAME, STATIC_FOLDER, ASSET_FOLDER, ASSET_BUNDLES
+from . import startup
+
+logger = logging.getLogger("py4web:" + APP_NAME)
+
+# The minifiers and brotli are optional: without them, the bundles are only
+# concatenated, and only gzipped.
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bundle name -> files of the static folder, in the order they are loaded.
+BUNDLES = {
+    'base.css': ['css/bulma.min.css', 'font-awesome-4.7.0/css/font-awesome.min.css'],
+    'base.js': ['js/sugar.min.js', 'js/axios.min.js', 'js/vue.js', 'js/utils.js'],
+    'index.js': ['js/index.js'],
+    'manage_products.js': ['js/manage_products.js'],
+    'view_orders.js': ['js/view_orders.js'],
+}
+
+MANIFEST = os.path.join(ASSET_FOLDER, 'manifest.json')
+
+REGEX_ASSET = re.compile(r"^[\w-]+\.[0-9a-f]{12}\.(js|css)$")
+REGEX_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+# Encodings of the precompressed files, by preference.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _css_urls(css, source):
+    """Rewrites the relative urls of the CSS file source so that they work
+    from the asset URLs, which are one level below the app, like static."""
+    folder = os.path.dirname(source)
+
+    def fix(m):
+        url = m.group(2)
+        if re.match(r"^(\w+:|/|#)", url):
+            return m.group(0)
+        path = os.path.normpath(os.path.join(folder, url)).replace(os.sep, '/')
+        return 'url(%s../static/%s%s)' % (m.group(1), path, m.group(1))
+
+    return REGEX_CSS_URL.sub(fix, css)
+
+
+def bundle(name):
+    """Returns the minified content of a bundle."""
+    parts = []
+    for source in BUNDLES[name]:
+        with open(os.path.join(STATIC_FOLDER, source), encoding='utf8') as f:
+            text = f.read()
+        if name.endswith('.css'):
+            parts.append(_css_urls(rcssmin.cssmin(text) if rcssmin else text, source))
+        else:
+            parts.append(rjsmin.jsmin(text) if rjsmin else text)
+    # The semicolon ends a last JS statement left without one.
+    return ('\n' if name.endswith('.css') else '\n;\n').join(parts).encode('utf8')
+
+
+def _write(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build():
+    """Builds all the bundles, and writes the manifest.  Returns the
+    manifest."""
+    previous = {}
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST) as f:
+            previous = json.load(f)
+    manifest = {}
+    for name in BUNDLES:
+        data = bundle(name)
+        base, ext = os.path.splitext(name)
+        filename = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+        path = os.path.join(ASSET_FOLDER, filename)
+        if not os.path.exists(path):
+            _write(path + '.gz', gzip.compress(data, 9))
+            if brotli is not None:
+                _write(path + '.br', brotli.compress(data, quality=11))
+            _write(path, data)
+        manifest[name] = filename
+    _write(MANIFEST, json.dumps(manifest, indent=1).encode('utf8'))
+    # Removes the files of the older builds.  Those of the previous build
+    # are kept for the pages, and the processes, that still refer to them.
+    keep = set(manifest.values()) | set(previous.values())
+    for filename in os.listdir(ASSET_FOLDER):
+        asset = filename[:-3] if filename.endswith(('.gz', '.br')) else filename
+        if REGEX_ASSET.match(asset) and asset not in keep:
+            os.unlink(os.path.join(ASSET_FOLDER, filename))
+    return manifest
+
+
+def is_stale():
+    """Tells if the manifest is missing, or older than a source file."""
+    if not os.path.exists(MANIFEST):
+        return True
+    built = os.path.getmtime(MANIFEST)
+    return any(os.path.getmtime(os.path.join(STATIC_FOLDER, source)) > built
+               for sources in BUNDLES.values() for source in sources)
+
+
+def load_manifest():
+    if is_stale():
+        logger.info("Building the static asset bundles")
+        return build()
+    with open(MANIFEST) as f:
+        return json.load(f)
+
+
+with startup.phase('assets'):
+    manifest = load_manifest() if ASSET_BUNDLES else {}
+
+
+def asset_path(filename, accept_encoding=''):
+    """Returns the path, the content type, and the encoding of the best file
+    to send for an asset, or None if there is no such asset."""
+    if not REGEX_ASSET.match(filename or ''):
+        return None
+    path = os.path.join(ASSET_FOLDER, filename)
+    if not os.path.exists(path):
+        return None
+    content_type = mimetypes.guess_type(filename)[0]
+    for encoding, ext in ENCODINGS:
+        if encoding in accept_encoding and os.path.exists(path + ext):
+            return path + ext, content_type, encoding
+    return path, content_type, None
+
+
+def tags(name):
+    """Returns the tag that loads a bundle, or, without bundles, the tags
+    that load its source files."""
+    if name in manifest:
+        urls = [URL('asset', manifest[name])]
+    else:
+        urls = [URL('static', source) for source in BUNDLES[name]]
+    if name.endswith('.css'):
+        return XML(''.join('<link rel="stylesheet" href="%s">' % u for u in urls))
+    return XML(''.join('<script src="%s"></script>' % u for u in urls))
+
+
+class Assets(Fixture):
+    """Gives the templates this module, as assets, for assets.tags()."""
+
+    def on_request(self, context):
+        context['template_inject']['assets'] = sys.modules[__name__]
+
+
+assets = Assets()
@@ -0,0 +1,336 @@
+"""
+Benchmark of the shop flows: boots the app on a temporary database, seeds
+it, runs a mix of concurrent customers and admins against it, and prints
+the latency percentiles and throughput of each action as JSON.
+
+    python apps/vue_shop/benchmark.py --threads 20 --seconds 30 \\
+        --products 5000 --orders 100000 --output before.json
+
+Run it again after a change, with --baseline before.json, to compare: the
+report then gives, for each action, the change of its p95 latency, and the
+benchmark fails if one grew by more than --tolerance.
+
+Before the run, stock.stress has concurrent customers compete for the last
+units of a product: the benchmark fails if more units are sold than there
+were.  At the end, the stock is audited (see stock.audit): the benchmark
+fails if a product was oversold, i.e. if a quantity went negative, or if
+the quantity left and the quantities reserved during the run do not add up
+to the stock before it.  The report gives the checkouts (paid orders) per
+second.  To stress the reservations, give the products little stock, so
+that the customers compete for the last items:
+
+    python apps/vue_shop/benchmark.py --products 50 --stock 20 --mix buy=1
+
+The app runs with `py4web run` in a temporary apps folder, on an SQLite
+database in a temporary folder (or on the empty Postgres database given by
+--db), with the fake payment gateway, so that nothing outside is touched
+(see the end of settings.py).  The data is added by seed.py.
+
+Each client repeatedly picks a flow, at random with the weights of --mix:
+
+- browse: two pages of the catalog, with a random sort;
+- search: a catalog search for a word of the product names;
+- checkout: the stock check of a cart;
+- buy: pay for a cart (waiting in the waiting room when told so), go
+  through the fake checkout page, and come back to successful_payment,
+  which marks the order as paid;
+- admin: the full product list of the product manager (load_products).
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    from .loadtest import Client, Stats
+except ImportError:
+    # Run as a script, rather than imported from the app.
+    from loadtest import Client, Stats
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+APP_NAME = os.path.basename(APP_FOLDER)
+
+DEFAULT_MIX = 'browse=60,search=20,checkout=10,buy=8,admin=2'
+
+# The vocabulary of the product names (see seed.py).
+SEARCH_WORDS = ['red', 'blue', 'green', 'black', 'cotton', 'wool', 'leather', 'steel',
+                'shirt', 'scarf', 'bag', 'mug', 'lamp', 'chair', 'notebook', 'clock']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def py4web(*args):
+    return [sys.executable, '-m', 'py4web'] + list(args)
+
+
+class Server:
+    """The app, run by py4web on a temporary database."""
+
+    def __init__(self, db_uri=None, threads=10):
+        self.folder = tempfile.mkdtemp(prefix='shop_benchmark_')
+        apps = os.path.join(self.folder, 'apps')
+        os.makedirs(os.path.join(self.folder, 'databases'))
+        os.makedirs(apps)
+        open(os.path.join(apps, '__init__.py'), 'w').close()
+        os.symlink(APP_FOLDER, os.path.join(apps, APP_NAME))
+        self.apps = apps
+        self.env = dict(os.environ,
+                        SHOP_BENCHMARK_FOLDER=os.path.join(self.folder, 'databases'),
+                        SHOP_BENCHMARK_DB_URI=db_uri or '',
+                        PY4WEB_THREADS=str(threads))
+        self.port = free_port()
+        self.base = 'http://127.0.0.1:%d/%s' % (self.port, APP_NAME)
+        self.process = None
+
+    def call(self, function, **kwargs):
+        """Calls a function of the app; returns the JSON it prints last, if
+        any."""
+        out = subprocess.run(py4web('call', self.apps, '%s.%s' % (APP_NAME, function),
+                                    '--args', json.dumps(kwargs)),
+                             env=self.env, cwd=self.folder, stdout=subprocess.PIPE,
+                             check=True, text=True).stdout
+        sys.stderr.write(out)
+        lines = [line for line in out.splitlines() if line.startswith('{')]
+        return json.loads(lines[-1]) if lines else None
+
+    def start(self, timeout=60):
+        self.log = open(os.path.join(self.folder, 'server.log'), 'w')
+        self.process = subprocess.Popen(
+            py4web('run', self.apps, '--port', str(self.port), '--watch', 'off',
+                   '--dashboard_mode', 'none', '--app_names', APP_NAME, '--yes'),
+            env=self.env, cwd=self.folder, stdout=self.log, stderr=subprocess.STDOUT)
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.process.poll() is not None:
+                break
+            try:
+                if Client(self.base).request(self.base + '/index')[0] == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("The server did not start; see %s" % self.log.name)
+
+    def stop(self, keep=False):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.log.close()
+        if keep:
+            print("The database and the server log are in %s" % self.folder, file=sys.stderr)
+        else:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class Customer:
+    """A client of the storefront, with the signed URLs of the index page."""
+
+    def __init__(self, base, stats):
+        self.client = Client(base, follow_redirects=False)
+        self.stats = stats
+        self.urls = self.client.urls('index')
+        self.products = []
+
+    def timed(self, name, path, body=None):
+        t0 = time.time()
+        try:
+            status, headers, data = self.client.open(path, body)
+        except OSError:
+            status, headers, data = 0, {}, b''  # Connection refused or reset.
+        self.stats.record(name, status, time.time() - t0)
+        return status, headers, data
+
+    def browse(self):
+        url = self.urls['products_url'] + '&sort=' + random.choice(['id', 'name', 'price'])
+        status, _, data = self.timed('get_products', url)
+        if status != 200:
+            return
+        page = json.loads(data)
+        self.products = [p['id'] for p in page['products'] if p['quantity']] or self.products
+        if page['next_cursor']:
+            self.timed('get_products', url + '&cursor=' + urllib.parse.quote(page['next_cursor']))
+
+    def search(self):
+        self.timed('search', self.urls['products_url'] + '&q=' + random.choice(SEARCH_WORDS))
+
+    def cart(self):
+        if not self.products:
+            self.browse()
+        return [dict(product_id=i, quantity=random.randint(1, 2))
+                for i in random.sample(self.products, min(len(self.products), random.randint(1, 3)))]
+
+    def checkout(self):
+        self.timed('checkout', self.urls['checkout_url'], dict(items=self.cart()))
+
+    def buy(self):
+        body = dict(items=self.cart(), fulfillment=dict(name='Benchmark customer'))
+        status, _, data = self.timed('pay', self.urls['pay_url'], body)
+        # In the waiting room (see admission.py), polls with the ticket.
+        while status == 200 and json.loads(data).get('ticket'):
+            time.sleep(json.loads(data)['retry_after'])
+            body['ticket'] = json.loads(data)['ticket']
+            status, _, data = self.timed('pay', self.urls['pay_url'], body)
+        if status != 200 or not json.loads(data).get('session_id'):
+            return
+        # The fake gateway "pays", and redirects to successful_payment.
+        session_id = json.loads(data)['session_id']
+        status, headers, _ = self.client.open(
+            self.urls['fake_checkout_url'] + '?session_id=' + session_id)
+        if status in (302, 303) and headers.get('Location'):
+            self.timed('successful_payment', headers['Location'])
+
+
+class Admin:
+    """A client of the product manager."""
+
+    def __init__(self, base, stats):
+        self.client = Client(base)
+        self.stats = stats
+        self.urls = self.client.urls('manage_products')
+
+    def admin(self):
+        t0 = time.time()
+        status, _ = self.client.request(self.urls['load_url'])
+        self.stats.record('load_products', status, time.time() - t0)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('browse', 'search', 'checkout', 'buy', 'admin'):
+            raise ValueError("Unknown flow %r" % name)
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def run_client(base, stop, stats, weights):
+    flows = list(weights)
+    customer, admin = Customer(base, stats), None
+    while not stop.is_set():
+        flow = random.choices(flows, list(weights.values()))[0]
+        if flow == 'admin':
+            admin = admin or Admin(base, stats)
+            admin.admin()
+        else:
+            getattr(customer, flow)()
+
+
+def paid_orders(actions):
+    """Returns the number of orders paid during the run: the successful
+    requests to successful_payment."""
+    result = actions.get('successful_payment')
+    return result['requests'] - sum(result['failed'].values()) if result else 0
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_FOLDER,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """Adds to the report the change of each p95 with respect to the
+    baseline.  Returns the actions that regressed by more than tolerance."""
+    regressions = []
+    for name, result in report['actions'].items():
+        before = baseline.get('actions', {}).get(name)
+        if not before or not before['p95_ms']:
+            continue
+        change = result['p95_ms'] / before['p95_ms'] - 1
+        result['p95_change'] = round(change, 3)
+        if change > tolerance:
+            regressions.append(name)
+    report['baseline_commit'] = baseline.get('commit')
+    report['regressions'] = regressions
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the shop flows.")
+    parser.add_argument('--threads', type=int, default=20, help="concurrent clients")
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3, help="seconds not measured")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="weights of the flows")
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--stock', type=int, default=1000000, help="items of each product")
+    parser.add_argument('--db', help="URI of an empty Postgres database, instead of SQLite")
+    parser.add_argument('--server-threads', type=int, default=10)
+    parser.add_argument('--output', help="file where to write the report")
+    parser.add_argument('--baseline', help="report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="p95 growth, over the baseline, that fails the benchmark")
+    parser.add_argument('--keep', action='store_true', help="keep the database and server log")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    server = Server(db_uri=args.db, threads=args.server_threads)
+    try:
+        server.call('seed.seed', products=args.products, orders=args.orders, stock=args.stock)
+        stress = server.call('stock.stress')
+        stock_file = os.path.join(server.folder, 'stock.json')
+        server.call('stock.audit', path=stock_file, save=True)
+        server.start()
+        stats, stop = Stats(), threading.Event()
+        threads = [threading.Thread(target=run_client, args=(server.base, stop, stats, weights),
+                                    daemon=True)
+                   for _ in range(args.threads)]
+        for t in threads:
+            t.start()
+        time.sleep(args.warmup)
+        stats.reset()
+        t0 = time.time()
+        time.sleep(args.seconds)
+        elapsed = time.time() - t0
+        stop.set()
+        for t in threads:
+            t.join()
+        audit = server.call('stock.audit', path=stock_file)
+    finally:
+        server.stop(keep=args.keep)
+
+    actions = stats.report(elapsed)
+    report = dict(
+        commit=git_commit(),
+        config=dict(threads=args.threads, seconds=args.seconds, mix=weights,
+                    products=args.products, orders=args.orders, stock=args.stock,
+                    database='postgres' if args.db else 'sqlite',
+                    server_threads=args.server_threads),
+        requests_per_second=round(sum(a['requests'] for a in actions.values()) / elapsed, 1),
+        checkouts_per_second=round(paid_orders(actions) / elapsed, 1),
+        stock=audit,
+        stress=stress,
+        actions=actions,
+    )
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if not audit['ok']:
+        print("The stock was oversold: %s" % json.dumps(audit), file=sys.stderr)
+    sys.exit(1 if regressions or not audit['ok'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+This file implements the bulk operations on the products: import and export
+in CSV or JSONL, and batch edits.
+
+Imports are read as a stream, and processed in chunks of IMPORT_CHUNK_SIZE
+rows: rows without an id (or with an id that does not exist) are inserted
+with a single bulk_insert per chunk, the others are updated.  The whole
+import runs in one transaction, and bumps the catalog version once, at the
+end, so that the checkouts do not wait for it (see stock.py).
+
+Exports read the products in keyset batches, and stream them out as they
+are read, so that memory use does not grow with the catalog.
+
+benchmark() imports and exports a synthetic catalog, and reports the rows
+per second; from the command line:
+
+    py4web call apps vue_shop.bulk.benchmark
+"""
+
+import csv
+import io
+import json
+import time
+
+from .common import db
+from .catalog import EDITABLE_FIELDS
+from .catalog_cache import stamp_products
+from .search import index_product, reindex_product, rebuild_index
+from .settings import IMPORT_CHUNK_SIZE
+
+EXPORT_FIELDS = ['id'] + list(EDITABLE_FIELDS)
+
+# How to convert the values read from CSV, where everything is a string.
+CONVERTERS = {
+    'quantity': int,
+    'price': float,
+}
+
+
+def clean_values(row):
+    """Returns the editable fields of row, converted to their types.
+    Raises ValueError if a value cannot be converted."""
+    values = {}
+    for field in EDITABLE_FIELDS:
+        if field in row:
+            v = row[field]
+            if v == '' or v is None:
+                v = None
+            elif field in CONVERTERS:
+                v = CONVERTERS[field](v)
+            values[field] = v
+    return values
+
+
+def parse_csv(stream):
+    """Yields the rows of a CSV byte stream, with a header line."""
+    for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+        yield row
+
+
+def parse_jsonl(stream):
+    """Yields the rows of a JSONL byte stream, one JSON object per line."""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _import_chunk(chunk):
+    ids = set()
+    for row in chunk:
+        try:
+            ids.add(int(row['id']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    existing = {r.id for r in db(db.product.id.belongs(ids)).select(db.product.id)} if ids else set()
+    new_rows, updated = [], []
+    for row in chunk:
+        values = clean_values(row)
+        try:
+            product_id = int(row['id'])
+        except (KeyError, TypeError, ValueError):
+            product_id = None
+        if product_id in existing:
+            db(db.product.id == product_id).update(**values)
+            if 'product_name' in values or 'description' in values:
+                reindex_product(product_id)
+            updated.append(product_id)
+        else:
+            new_rows.append(values)
+    new_ids = db.product.bulk_insert(new_rows) if new_rows else []
+    for product_id, values in zip(new_ids, new_rows):
+        index_product(product_id, values.get('product_name'), values.get('description'))
+    return list(new_ids), updated
+
+
+def import_rows(rows, chunk_size=None):
+    """Imports the products in the iterable rows.  Returns the number of
+    products inserted and updated, and the revision they were given.
+    Raises ValueError on invalid values."""
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    inserted, updated = [], []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            i, u = _import_chunk(chunk)
+            inserted.extend(i)
+            updated.extend(u)
+            chunk = []
+    if chunk:
+        i, u = _import_chunk(chunk)
+        inserted.extend(i)
+        updated.extend(u)
+    # The version is bumped last, so that its row is not locked while the
+    # products are written (see stock.py).
+    revision = stamp_products(inserted + updated, chunk_size=chunk_size)
+    return dict(inserted=len(inserted), updated=len(updated), revision=revision)
+
+
+def export_rows(batch_size=1000):
+    """Yields all the products, as dictionaries, reading them in batches."""
+    fields = [db.product[f] for f in EXPORT_FIELDS]
+    last_id = 0
+    while True:
+        rows = db(db.product.id > last_id).select(
+            *fields, orderby=db.product.id, limitby=(0, batch_size)).as_list()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1]['id']
+
+
+def export_csv(rows):
+    """Yields a CSV export of rows, in chunks of bytes."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for n, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if n % 1000 == 0:
+            yield buf.getvalue().encode('utf8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf8')
+
+
+def export_jsonl(rows):
+    """Yields a JSONL export of rows, in chunks of bytes."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row))
+        if len(lines) == 1000:
+            yield ("\n".join(lines) + "\n").encode('utf8')
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode('utf8')
+
+
+def edit_rows(changes):
+    """Applies a list of {id, field, value} changes, with one update per
+    product.  Raises ValueError on fields that cannot be edited."""
+    by_id = {}
+    for change in changes:
+        if change.get('field') not in EDITABLE_FIELDS:
+            raise ValueError("Field %r cannot be edited" % change.get('field'))
+        by_id.setdefault(int(change['id']), {})[change['field']] = change.get('value')
+    if not by_id:
+        return 0
+    for product_id in sorted(by_id):
+        values = by_id[product_id]
+        db(db.product.id == product_id).update(**clean_values(values))
+        if 'product_name' in values or 'description' in values:
+            reindex_product(product_id)
+    stamp_products(by_id)
+    return len(by_id)
+
+
+def benchmark(n=50000):
+    """Imports n synthetic products from CSV, updates them all with a second
+    import, exports them, and deletes them; prints and returns the rows per
+    second of each step.  Use it on a development database."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=list(EDITABLE_FIELDS))
+    writer.writeheader()
+    for i in range(n):
+        writer.writerow(dict(product_name='Benchmark product %d' % i, quantity=i % 100,
+                             price=i % 1000 / 10.0, description='Synthetic product number %d' % i))
+    data = buf.getvalue().encode('utf8')
+
+    t0 = time.time()
+    result = import_rows(parse_csv(io.BytesIO(data)))
+    db.commit()
+    t1 = time.time()
+    ids = [r.id for r in db(db.product.revision == result['revision']).select(db.product.id)]
+    import_rows([dict(id=i, price=1.0) for i in ids])
+    db.commit()
+    t2 = time.time()
+    exported = sum(1 for _ in export_jsonl(export_rows()))
+    t3 = time.time()
+
+    for k in range(0, len(ids), 1000):
+        db(db.product.id.belongs(ids[k:k + 1000])).delete()
+    db.commit()
+    rebuild_index()
+    stats = dict(
+        rows=n,
+        inserted=result['inserted'],
+        insert_rows_per_second=round(n / max(t1 - t0, 1e-9)),
+        update_rows_per_second=round(n / max(t2 - t1, 1e-9)),
+        export_rows_per_second=round(n / max(t3 - t2, 1e-9)),
+        export_chunks=exported,
+    )
+    print(json.dumps(stats))
+    return stats
@@ -0,0 +1,113 @@
+"""
+This file contains the queries that build the storefront catalog.
+
+The catalog is paginated with keyset cursors: rather than skipping over
+OFFSET rows, each page starts right after the (sort key, id) of the last
+product of the previous page, so every page costs the same no matter how
+deep into the catalog it is.  Search results are ranked by the full-text
+index (see search.py), and their cursors hold the rank of the next result.
+"""
+
+import base64
+import json
+
+from .common import db
+from .search import search_products
+from .settings import CATALOG_PAGE_SIZE, CATALOG_MAX_PAGE_SIZE
+
+# Columns needed by the storefront product list.
+STOREFRONT_FIELDS = ['id', 'product_name', 'quantity', 'price', 'image', 'description']
+
+# Columns of the products that can be edited and imported.
+EDITABLE_FIELDS = ('product_name', 'quantity', 'price', 'description')
+
+# Sort orders accepted by the catalog, mapped to the field they sort on.
+SORT_FIELDS = {
+    'id': 'id',
+    'name': 'product_name',
+    'price': 'price',
+}
+
+
+def encode_cursor(sort_value, product_id):
+    """Encodes the position of a product in the catalog as an opaque string."""
+    s = json.dumps([sort_value, product_id])
+    return base64.urlsafe_b64encode(s.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor; returns None if invalid."""
+    try:
+        sort_value, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(product_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def page_limit(limit):
+    """Parses a requested page size, clamping it to the allowed range."""
+    try:
+        limit = int(limit)
+    except (ValueError, TypeError):
+        return CATALOG_PAGE_SIZE
+    return max(1, min(limit, CATALOG_MAX_PAGE_SIZE))
+
+
+def sort_order(sort_field):
+    """Returns the orderby of the catalog sorted on sort_field, then on id,
+    with the NULLs first, as the cursors expect: SQLite and MySQL sort them
+    first, while Postgres needs to be told."""
+    if sort_field is db.product.id:
+        return db.product.id
+    if db._dbname == 'postgres':
+        return '%s NULLS FIRST, %s' % (sort_field.sqlsafe, db.product.id.sqlsafe)
+    return sort_field | db.product.id
+
+
+def product_page(query, sort='id', cursor=None, limit=None):
+    """Returns (products, next_cursor) for one page of the products matching
+    query.  next_cursor is None on the last page."""
+    sort_field = db.product[SORT_FIELDS.get(sort, 'id')]
+    limit = page_limit(limit)
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        sort_value, last_id = position
+        if sort_field is db.product.id:
+            query &= db.product.id > last_id
+        elif sort_value is None:
+            # NULLs come first in the ordering (see sort_order()).
+            query &= (((sort_field == None) & (db.product.id > last_id)) |
+                      (sort_field != None))
+        else:
+            query &= ((sort_field > sort_value) |
+                      ((sort_field == sort_value) & (db.product.id > last_id)))
+    orderby = sort_order(sort_field)
+    fields = [db.product[f] for f in STOREFRONT_FIELDS]
+    # Reads one extra row to know whether there is a next page.
+    products = db(query).select(*fields, orderby=orderby, limitby=(0, limit + 1)).as_list()
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        last = products[-1]
+        next_cursor = encode_cursor(last[sort_field.name], last['id'])
+    return products, next_cursor
+
+
+def search_page(text, cursor=None, limit=None):
+    """Returns (products, next_cursor) for one page of the products matching
+    the search text, best matches first."""
+    limit = page_limit(limit)
+    position = decode_cursor(cursor) if cursor else None
+    offset = position[1] if position is not None else 0
+    ids = search_products(text, offset=offset, limit=limit + 1)
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = encode_cursor('rank', offset + limit)
+    if not ids:
+        return [], None
+    fields = [db.product[f] for f in STOREFRONT_FIELDS]
+    rows = db(db.product.id.belongs(ids)).select(*fields).as_list()
+    by_id = {r['id']: r for r in rows}
+    products = [by_id[i] for i in ids if i in by_id]
+    return products, next_cursor
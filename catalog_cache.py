@@ -0,0 +1,165 @@
+"""
+This file implements the cache of the storefront catalog.
+
+Every change to the products (or to their stock) bumps the catalog version,
+and cached catalog pages are keyed by the version: after a change, the
+older pages are simply never asked for again, and age out of the cache.
+
+The version is kept in the catalog_state table, and bumped in the same
+transaction as the change, so all the py4web processes agree on it.  Each
+process re-reads it at most every CATALOG_VERSION_TTL seconds, from each
+database it reads from (see replicas.py).  The pages are kept in the
+in-process common.cache, or, with CATALOG_CACHE set to "redis" or
+"memcache", in a server shared by all the processes.
+
+benchmark() compares the throughput of the catalog with a cold and a warm
+cache; from the command line:
+
+    py4web call apps vue_shop.catalog_cache.benchmark
+"""
+
+import json
+import threading
+import time
+
+from .common import db, cache
+from .replicas import replicas
+from . import settings
+
+_lock = threading.Lock()
+# Database (replicas.current()) -> dict(value=..., content=..., read_on=...).
+_versions = {}
+stats = dict(hits=0, misses=0)
+
+
+def _connect():
+    if settings.CATALOG_CACHE == "redis":
+        import redis
+
+        host, port = settings.REDIS_SERVER.split(":")
+        return redis.Redis(host=host, port=int(port))
+    if settings.CATALOG_CACHE == "memcache":
+        import memcache
+
+        return memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
+    return None
+
+
+conn = _connect()
+
+
+def _state():
+    now = time.time()
+    state = _versions.setdefault(replicas.current(), dict(value=None, content=None, read_on=0))
+    if state['value'] is None or now - state['read_on'] > settings.CATALOG_VERSION_TTL:
+        row = db.catalog_state(1)
+        state.update(value=row.version if row else 0,
+                     content=(row.content_version or 0) if row else 0, read_on=now)
+    return state
+
+
+def catalog_version():
+    """Returns the current catalog version."""
+    return _state()['value']
+
+
+def content_version():
+    """Returns the current version of the catalog without its stock: it is
+    not bumped by the changes of the quantities alone."""
+    return _state()['content']
+
+
+def bump_catalog_version(stock_only=False):
+    """Records that the catalog has changed, and returns the new version,
+    which is also used as revision of the changed products.  As the version
+    row stays locked until the transaction commits, revisions are assigned
+    in commit order; call it last, after locking the products, so that the
+    row is not held for the rest of the transaction (see stock.py).  With
+    stock_only, only the quantities have changed, and the content version
+    stays the same."""
+    changes = dict(version=db.catalog_state.version + 1)
+    if not stock_only:
+        changes['content_version'] = db.catalog_state.content_version.coalesce_zero() + 1
+    db(db.catalog_state.id == 1).update(**changes)
+    # Forces this process to read the new version (once it is committed).
+    _versions.clear()
+    return db.catalog_state(1).version
+
+
+def stamp_products(product_ids, stock_only=False, chunk_size=1000):
+    """Bumps the catalog version, and makes it the revision of the products,
+    which have just been written (with any revision, as a placeholder).
+    Call it last in the transaction, after the writes to the products.
+    Returns the revision."""
+    revision = bump_catalog_version(stock_only=stock_only)
+    ids = sorted(product_ids)
+    for i in range(0, len(ids), chunk_size):
+        db(db.product.id.belongs(ids[i:i + chunk_size])).update(revision=revision)
+    return revision
+
+
+def _count(outcome):
+    with _lock:
+        stats[outcome] += 1
+
+
+def cached_page(params, compute):
+    """Returns the catalog page described by the dictionary params, calling
+    compute() to build it if it is not in the cache."""
+    key = "%s:catalog:%s:%s" % (settings.APP_NAME, catalog_version(),
+                                json.dumps(params, sort_keys=True))
+    if conn is None:
+        misses = []
+
+        def callback():
+            misses.append(1)
+            return compute()
+
+        value = cache.get(key, callback, settings.CATALOG_CACHE_EXPIRATION)
+        _count('misses' if misses else 'hits')
+        return value
+    data = conn.get(key)
+    if data is not None:
+        _count('hits')
+        return json.loads(data)
+    _count('misses')
+    value = compute()
+    if settings.CATALOG_CACHE == "redis":
+        conn.set(key, json.dumps(value), ex=settings.CATALOG_CACHE_EXPIRATION)
+    else:
+        conn.set(key, json.dumps(value), time=settings.CATALOG_CACHE_EXPIRATION)
+    return value
+
+
+def cache_stats():
+    """Returns the hit and miss counters of this process."""
+    with _lock:
+        total = stats['hits'] + stats['misses']
+        return dict(stats, hit_ratio=stats['hits'] / total if total else None)
+
+
+def benchmark(n=2000, limit=None):
+    """Measures the pages per second of the first catalog page, computed
+    every time (cold) and served from the cache (warm)."""
+    from .catalog import product_page
+
+    def compute():
+        products, next_cursor = product_page(db.product.id > 0, limit=limit)
+        return dict(products=products, next_cursor=next_cursor)
+
+    t0 = time.time()
+    for _ in range(n):
+        compute()
+    cold = time.time() - t0
+    t0 = time.time()
+    for _ in range(n):
+        cached_page(dict(limit=limit, benchmark=True), compute)
+    warm = time.time() - t0
+    result = dict(
+        requests=n,
+        cold_per_second=round(n / max(cold, 1e-9)),
+        warm_per_second=round(n / max(warm, 1e-9)),
+        stats=cache_stats(),
+    )
+    print(json.dumps(result))
+    return result
@@ -14,6 +14,9 @@ from pydal.tools.tags import Tags
 from py4web.utils.factories import ActionFactory
 from py4web.utils.form import FormStyleBulma
 from . import settings
+from . import metrics
+from . import startup
+from .assets import assets
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -35,13 +38,34 @@ for item in settings.LOGGERS:
 # #######################################################
 # connect to db
 # #######################################################
-db = DAL(
-    settings.DB_URI,
-    folder=settings.DB_FOLDER,
-    pool_size=settings.DB_POOL_SIZE,
-    migrate=settings.DB_MIGRATE,
-    fake_migrate=settings.DB_FAKE_MIGRATE,
-)
+def after_connection(adapter):
+    """Configures each new SQLite connection: with WAL, readers do not wait
+    for the writer, and writers wait for each other rather than failing
+    with "database is locked"."""
+    if adapter.dbengine == "sqlite":
+        if settings.DB_WAL:
+            adapter.execute("PRAGMA journal_mode=WAL;")
+            adapter.execute("PRAGMA synchronous=NORMAL;")
+        adapter.execute("PRAGMA busy_timeout=%d;" % (settings.DB_BUSY_TIMEOUT * 1000))
+
+
+# the migrations are not checked when the schema is the same as when they
+# last ran (see startup.py)
+schema_unchanged = (settings.DB_MIGRATE and settings.DB_SKIP_UNCHANGED_MIGRATIONS
+                    and not settings.DB_FAKE_MIGRATE and not startup.schema_changed())
+migrate = settings.DB_MIGRATE and not schema_unchanged
+
+with startup.phase('db'):
+    db = DAL(
+        settings.DB_URI,
+        folder=settings.DB_FOLDER,
+        pool_size=settings.DB_POOL_SIZE or settings.WEB_THREADS,
+        migrate=migrate,
+        fake_migrate=settings.DB_FAKE_MIGRATE,
+        after_connection=after_connection,
+    )
+# times the queries of the instrumented requests (see metrics.py)
+metrics.install(db)
 
 # #######################################################
 # define global objects that may or may not be used by the actions
@@ -53,9 +77,8 @@ flash = Flash()
 # #######################################################
 # pick the session type that suits you best
 # #######################################################
-if settings.SESSION_TYPE == "cookies":
-    session = Session(secret=settings.SESSION_SECRET_KEY)
-elif settings.SESSION_TYPE == "redis":
+storage = None
+if settings.SESSION_TYPE == "redis":
     import redis
 
     host, port = settings.REDIS_SERVER.split(":")
@@ -66,16 +89,23 @@ elif settings.SESSION_TYPE == "redis":
         if ct(k) >= 0
         else cs(k, v, e)
     )
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    storage = conn
 elif settings.SESSION_TYPE == "memcache":
     import memcache, time
 
-    conn = memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    storage = memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
 elif settings.SESSION_TYPE == "database":
     from py4web.utils.dbstore import DBStore
 
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
+    storage = DBStore(db)
+
+# server side sessions are read from, and written to, the storage only when
+# needed (see sessions.py)
+if storage is not None and settings.SESSION_CACHE_SIZE:
+    from .sessions import CachedStore
+
+    storage = CachedStore(storage, db=db if settings.SESSION_TYPE == "database" else None)
+session = Session(secret=settings.SESSION_SECRET_KEY, storage=storage)
 
 # #######################################################
 # Instantiate the object and actions that handle auth
@@ -109,7 +139,8 @@ auth.param.login_expiration_time = 3600
 auth.param.password_complexity = {"entropy": 2}
 auth.param.block_previous_password_num = 3
 auth.param.formstyle = FormStyleBulma
-auth.define_tables()
+with startup.phase('auth'):
+    auth.define_tables()
 
 # #######################################################
 # Configure email sender for auth
@@ -205,7 +236,8 @@ if settings.USE_CELERY:
 # #######################################################
 # Enable authentication
 # #######################################################
-auth.enable(uses=(session, T, db), env=dict(T=T))
+with startup.phase('auth'):
+    auth.enable(uses=(session, T, db, assets), env=dict(T=T))
 
 # #######################################################
 # Define convenience decorators
@@ -25,25 +25,52 @@ session, db, T, auth, and tempates are examples of Fixtures.
 Warning: Fixtures MUST be declared with @action.uses({fixtures}) else your app will result in undefined behavior
 """
 
+import csv
 import datetime
-from functools import reduce
 import json
+import mimetypes
 import os
 import traceback
 
-from py4web import action, request, abort, redirect, URL
+from py4web import action, request, response, abort, redirect, URL
 from yatl.helpers import A
-from .common import db, session, T, cache, auth, logger, authenticated, unauthenticated, flash
+from .common import db, session, T, cache, auth, groups, logger, authenticated, unauthenticated, flash
 from py4web.utils.url_signer import URLSigner
+from .signing import StatelessURLSigner
 from .models import get_user_email
-from .settings import APP_FOLDER, APP_NAME
+from .images import store_image, image_path, image_url
+from .catalog import product_page, search_page, EDITABLE_FIELDS
+from . import bulk
+from .catalog_cache import cached_page, catalog_version, bump_catalog_version, stamp_products, cache_stats
+from . import metrics
+from .metrics import instrument
+from .reaper import reaper, check_late_payments
+from .assets import assets, asset_path
+from .responses import etag_for, not_modified, send_json
+from .search import index_product, unindex_product, reindex_product
+from . import snapshot
+from . import stock
+from .orders import insert_order_lines, record_paid
+from .admission import gate, stock_counter, BUSY, QUEUED, PROCESS_ID
+from .replicas import replicas
+from . import orders
+from .payments import gateway, FakeGateway, PaymentError, queue_checkout_session
+from .settings import APP_FOLDER, APP_NAME, PAYMENT_GATEWAY, PAYMENT_MODE, PAYMENT_WEBHOOK_SECRET, METRICS_TOKEN
+from .settings import PROFILER_GROUP, PROFILE_MAX_SECONDS
+from . import profiler
+from . import startup
+from . import webhooks
 
 from py4web.utils.form import Form, FormStyleBulma
-from py4web.utils.grid import Grid, GridClassStyleBulma
 
-import stripe
+# Every action uses instrument, and so starts the reaper thread with the
+# first request of the process (see reaper.py).
+instrument.__prerequisites__ = [reaper]
 
 url_signer = URLSigner(session)
+# The storefront APIs are signed with a server secret, so that they are
+# verified without loading the session (see signing.py).
+storefront_signer = StatelessURLSigner()
 
 def nicefy(b):
     if b is None:
@@ -52,91 +79,172 @@ def nicefy(b):
     s = json.dumps(obj, indent=2)
     return s
 
-# Reads the stripe keys.
-with open(os.path.join(APP_FOLDER, 'private', 'stripe_keys.json'), 'r') as f:
-    STRIPE_KEY_INFO = json.load(f)
-stripe.api_key = STRIPE_KEY_INFO['test_private_key']
-
 def full_url(u):
     p = request.urlparts
     return p.scheme + "://" + p.netloc + u
 
+def with_image_urls(p):
+    """Replaces the image key of a product dict with the image URLs."""
+    key = p.pop('image', None)
+    p['image'] = image_url(key)
+    p['thumbnail'] = image_url(key, thumbnail=True)
+    return p
+
 @action('index')
-@action.uses('index.html', db, url_signer)
+@action.uses(instrument, 'index.html', db, storefront_signer, assets)
 def index():
     return dict(
-        products_url = URL('get_products', signer=url_signer),
-        checkout_url = URL('checkout', signer=url_signer),
-        pay_url = URL('pay', signer=url_signer),
+        products_url = URL('get_products', signer=storefront_signer),
+        checkout_url = URL('checkout', signer=storefront_signer),
+        pay_url = URL('pay', signer=storefront_signer),
         clear_cart = 'true' if request.params.get('clear_cart') else 'false',
-        stripe_key = STRIPE_KEY_INFO['test_public_key'],
+        stripe_key = gateway.public_key,
+        fake_checkout_url = URL('fake_checkout') if PAYMENT_GATEWAY == 'fake' else '',
         app_name = APP_NAME,
     )
 
 @action('get_products')
-@action.uses(db, url_signer.verify())
+@action.uses(instrument, replicas, storefront_signer.verify())
 def get_products():
-    """Gets the list of products, possibly in response to a query."""
-    t = request.params.get('q')
-    if t:
-        tt = t.strip()
-        q = ((db.product.product_name.contains(tt)) |
-             (db.product.description.contains(tt)))
+    """Gets a page of the list of products, possibly in response to a query.
+    The page starts after the position given by the `cursor` parameter;
+    the response contains the cursor of the next page, if any."""
+    params = dict(
+        q=(request.params.get('q') or '').strip(),
+        sort=request.params.get('sort', 'id'),
+        cursor=request.params.get('cursor'),
+        limit=request.params.get('limit'),
+    )
+    etag = etag_for('get_products', catalog_version(), params)
+    if not_modified(etag):
+        return ""
+    page = snapshot.catalog_page(**params)
+    if page is None:
+        page = cached_page(params, lambda: catalog_page(**params))
+    return send_json(page, etag=etag)
+
+def catalog_page(q='', sort='id', cursor=None, limit=None):
+    """Computes a page of the storefront catalog."""
+    if q:
+        products, next_cursor = search_page(q, cursor=cursor, limit=limit)
     else:
-        q = db.product.id > 0
-    # This is a bit simplistic; normally you would return only some of
-    # the products... and add pagination... this is up to you to fix.
-    products = db(q).select(db.product.ALL).as_list()
+        products, next_cursor = product_page(
+            db.product.id > 0, sort=sort, cursor=cursor, limit=limit)
     # Fixes some fields, to make it easy on the client side.
     for p in products:
+        with_image_urls(p)
         p['desired_quantity'] = min(1, p['quantity'])
         p['cart_quantity'] = 0
     return dict(
         products=products,
+        next_cursor=next_cursor,
     )
 
-def check_enough(items):
-    have_enough = True
+def load_cart_products(items):
+    """Loads, with a single query, the products referenced by the cart items.
+    Returns a dictionary from product id to product."""
+    ids = set()
     for it in items:
-        # I look up the product; I don't trust the user to tell me the cost.
-        p = db.product(it['product_id'])
-        if p is None:
-            have_enough = False
-            break
-        # Checks if I have enough.  If not, stop.
-        if p.quantity < it['quantity']:
-            have_enough = False
-            break
-    return have_enough
+        try:
+            ids.add(int(it['product_id']))
+        except (KeyError, ValueError, TypeError):
+            pass
+    if not ids:
+        return {}
+    # I look up the product; I don't trust the user to tell me the cost.
+    rows = db(db.product.id.belongs(ids)).select(
+        db.product.id, db.product.product_name, db.product.price, db.product.quantity)
+    return {p.id: p for p in rows}
+
+def cart_wanted(items):
+    """Returns the dictionary from product id to quantity of the cart, or
+    None if the cart is not valid."""
+    try:
+        return stock.cart_quantities(items)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+def check_enough(items, products=None):
+    """Checks that there is enough stock for the items.  products is the
+    dictionary returned by load_cart_products, which is read if not given."""
+    if products is None:
+        products = load_cart_products(items)
+    wanted = {}
+    for it in items:
+        try:
+            product_id, quantity = int(it['product_id']), int(it['quantity'])
+        except (KeyError, ValueError, TypeError):
+            return False
+        if product_id not in products or quantity < 0:
+            return False
+        wanted[product_id] = wanted.get(product_id, 0) + quantity
+    # Checks if I have enough.
+    return all((products[i].quantity or 0) >= n for i, n in wanted.items())
 
 @action('checkout', method="POST")
-@action.uses(db, url_signer.verify())
+@action.uses(instrument, db, storefront_signer.verify())
 def checkout():
     """Checks that we have enough items in stock."""
     items = request.json.get('items')
-    return dict(ok=check_enough(items))
+    wanted = cart_wanted(items)
+    if wanted and not stock_counter.covers(wanted):
+        return dict(ok=False, sold_out=True)
+    products = load_cart_products(items)
+    stock_counter.update({i: p.quantity for i, p in products.items()})
+    return dict(ok=check_enough(items, products))
 
 @action('pay', method="POST")
-@action.uses(db, url_signer.verify())
+@action.uses(instrument, db, storefront_signer.verify(), replicas.writes())
 def pay():
+    """Admits the payment (see admission.py), and processes it.  Customers
+    who cannot be admitted yet get a ticket of the waiting room, and call
+    again with it after retry_after seconds."""
+    items = request.json.get('items')
+    wanted = cart_wanted(items)
+    if not wanted:
+        return dict(ok=False)
+    if not stock_counter.covers(wanted):
+        return dict(ok=False, sold_out=True)
+    status, ticket, position = gate.enter(wanted, request.json.get('ticket'))
+    if status == BUSY:
+        return dict(ok=False, error="busy")
+    if status == QUEUED:
+        # The polls of the ticket should reach this process (see admission.py).
+        response.set_cookie(APP_NAME + '_gate', PROCESS_ID, path='/', httponly=True,
+                            samesite='Lax')
+        return dict(ok=False, ticket=ticket, position=position,
+                    retry_after=gate.retry_after(position))
+    try:
+        return process_payment(items, wanted, request.json.get('fulfillment'))
+    finally:
+        gate.leave(wanted)
+
+def process_payment(items, wanted, fulfillment):
     """Checks (again) that we have enough items in stock, builds the Stripe
     checkout sessions, and returns its id."""
-    items = request.json.get('items')
-    fulfillment = request.json.get('fulfillment')
-    if not check_enough(items):
+    products = load_cart_products(items)
+    stock_counter.update({i: p.quantity for i, p in products.items()})
+    if not check_enough(items, products):
         return dict(ok=False)
     # TODO: Normally here I would validate the fulfillment info.
     # See https://stripe.com/docs/payments/checkout/migration#api-products
     # Insert non-paid order (the customer has not checked out yet).
+    order_id = db.customer_order.insert(
+        ordered_items=json.dumps(items),
+        fulfillment=json.dumps(fulfillment),
+    )
+    # I take the quantities out of the stock, as they are now on reserve.
+    # The check above is only a fast path: the reservation is what guarantees
+    # that concurrent customers do not buy the same items.
+    if not stock.reserve(order_id, items):
+        # Somebody else took the stock since it was read.
+        stock_counter.forget(wanted)
+        return dict(ok=False)
+    stock_counter.take(wanted)
+    insert_order_lines(order_id, items, products)
     line_items = []
     for it in items:
-        # I look up the product; I don't trust the user to tell me the cost.
-        p = db.product(it['product_id'])
-        # I decrement the quantity, as it is now on reserve. I may have to
-        # periodically check the uncompleted orders that are old ("abandoned")
-        # to recover committed, unclaimed quantity.
-        p.quantity -= int(it['quantity'])
-        p.update_record()
+        p = products[int(it['product_id'])]
         line_item = {
             'quantity': int(it['quantity']),
             'price_data': {
@@ -149,57 +257,157 @@ def pay():
             }
         }
         line_items.append(line_item)
-    order_id = db.customer_order.insert(
-        ordered_items=json.dumps(items),
-        fulfillment=json.dumps(fulfillment),
-    )
-    stripe_session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        line_items=line_items,
-        mode='payment',
-        success_url=full_url(URL('successful_payment', order_id, signer=url_signer)),
-        cancel_url=full_url(URL('cancelled_payment', order_id, signer=url_signer)),
-    )
+    success_url = full_url(URL('successful_payment', order_id, signer=storefront_signer))
+    cancel_url = full_url(URL('cancelled_payment', order_id, signer=storefront_signer))
+    # The order and the reservation are committed before contacting the
+    # payment gateway, so that the db is not locked while we wait for it.
+    db.commit()
+    if PAYMENT_MODE == 'queued':
+        queue_checkout_session(order_id, line_items, success_url, cancel_url)
+        return dict(ok=True,
+                    status_url=URL('payment_session', order_id, signer=storefront_signer))
+    try:
+        session_id = gateway.create_checkout_session(
+            line_items, success_url, cancel_url, order_id)
+    except PaymentError as e:
+        logger.error("Could not create the checkout session of order %s: %s", order_id, e)
+        stock.release(order_id)
+        db(db.customer_order.id == order_id).delete()
+        return dict(ok=False, error="payment_unavailable")
+    db(db.customer_order.id == order_id).update(
+        payment_session_id=session_id, payment_status='ready')
     return dict(ok=True,
-                session_id=stripe_session.id)
+                session_id=session_id)
+
+@action('payment_session/<order_id:int>')
+@action.uses(instrument, db, storefront_signer.verify())
+def payment_session(order_id=None):
+    """Returns the status of the checkout session of an order, which in queued
+    mode is created in the background; the client polls this until it is
+    ready or failed."""
+    order = db.customer_order(int(order_id))
+    if order is None:
+        return dict(status='failed')
+    return dict(status=order.payment_status,
+                session_id=order.payment_session_id)
 
 @action('successful_payment/<order_id:int>')
-@action.uses(url_signer.verify())
+@action.uses(instrument, db, storefront_signer.verify(), replicas.writes())
 def successful_payment(order_id=None):
-    ## TODO: Really we shoud set up a webhook for this.  But this makes test easy.
-    order = db(db.customer_order.id == int(order_id)).select().first()
-    if order is None:
-        redirect(URL('index'))
-    order.paid = True
-    order.paid_on = datetime.datetime.utcnow()
-    order.update_record()
+    # When the Stripe webhook is configured, it is the webhook that marks the
+    # order as paid; the redirect cannot be trusted.  Otherwise, as this makes
+    # testing easy, we trust it.
+    if not PAYMENT_WEBHOOK_SECRET:
+        order = db(db.customer_order.id == int(order_id)).select().first()
+        if order is None:
+            redirect(URL('index'))
+        if not order.paid:
+            order.paid = True
+            order.paid_on = datetime.datetime.utcnow()
+            order.update_record()
+            record_paid([order.id], order.paid_on)
+            check_late_payments([order.id])
+        stock.commit([order.id])
     redirect(URL('index', vars=dict(clear_cart='y')))
 
+@action('stripe_webhook', method="POST")
+@action.uses(instrument, db)
+def stripe_webhook():
+    """Receives the events sent by Stripe.  Events are recorded, and then
+    applied to the orders in batches, in the background."""
+    try:
+        event = webhooks.receive(request.body.read(),
+                                 request.headers.get('Stripe-Signature'))
+    except ValueError:
+        abort(400)
+    if webhooks.record(event):
+        db.commit()
+        webhooks.schedule_apply()
+    return "ok"
+
 @action('cancelled_payment/<order_id:int>')
-@action.uses(url_signer.verify())
+@action.uses(instrument, db, storefront_signer.verify(), replicas.writes())
 def cancelled_payment(order_id=None):
-    try:
-        db(db.customer_order.id == int(order_id)).delete()
-    except:
-        pass
+    # Gives back the reserved quantities, unless the order has been paid.
+    order = db.customer_order(int(order_id))
+    if order is not None and not order.paid:
+        stock.release(order.id)
+        order.delete_record()
     redirect(URL('index'))
 
-@action('view_orders', method=['POST', 'GET'])
-@action('view_orders/<path:path>', method=['POST', 'GET'])
-@action.uses('view_orders.html', db, auth, session)
-def view_orders(path=None):
+@action('fake_checkout')
+@action.uses(instrument, db, storefront_signer)
+def fake_checkout():
+    """Stands for the checkout page of the payment gateway, when the gateway
+    is fake: the payment succeeds at once."""
+    if PAYMENT_GATEWAY != 'fake':
+        abort(404)
+    session_id = request.params.get('session_id')
+    order = db.customer_order(FakeGateway.order_of(session_id))
+    if order is None or order.payment_session_id != session_id:
+        abort(404)
+    redirect(URL('successful_payment', order.id, signer=storefront_signer))
+
+@action('view_orders')
+@action.uses(instrument, 'view_orders.html', db, auth, session, url_signer, assets)
+def view_orders():
     """In a realistic example, here you should check that the person is
         authorized to view the orders."""
-    grid = Grid(path,
-                query=reduce(lambda a, b: (a & b), [db.customer_order.id > 0]),
-                orderby=[db.customer_order.id],
-                grid_class_style=GridClassStyleBulma,
-                formstyle=FormStyleBulma,
-                )
-    return dict(grid=grid)
+    return dict(
+        load_orders_url = URL('load_orders', signer=url_signer),
+        order_details_url = URL('order_details', signer=url_signer),
+    )
+
+def parse_date(s):
+    """Parses a YYYY-MM-DD date parameter; returns None if absent or invalid."""
+    try:
+        return datetime.date.fromisoformat(s)
+    except (TypeError, ValueError):
+        return None
+
+@action('load_orders')
+@action.uses(instrument, url_signer.verify(), replicas)
+def load_orders():
+    """Returns a page of the orders, filtered by paid status (paid=yes|no)
+    and by creation date (start, end), with the approximate number of
+    matching orders and the daily sales of the period."""
+    paid = {'yes': True, 'no': False}.get(request.params.get('paid'))
+    start = parse_date(request.params.get('start'))
+    end = parse_date(request.params.get('end'))
+    try:
+        rows, next_cursor = orders.order_page(paid, start, end,
+                                              cursor=request.params.get('cursor'))
+    except ValueError:
+        abort(400)
+    result = dict(orders=rows, next_cursor=next_cursor)
+    if not request.params.get('cursor'):
+        # The first page also carries the summaries; without dates, the
+        # daily sales are those of the last 30 days.
+        if start is None and end is None:
+            sales = orders.daily_sales(datetime.date.today() - datetime.timedelta(days=30))
+        else:
+            sales = orders.daily_sales(start, end)
+        result.update(count=orders.order_count(paid, start, end), daily_sales=sales)
+    return send_json(result)
+
+@action('order_details')
+@action.uses(instrument, url_signer.verify(), replicas)
+def order_details():
+    """Returns the items and fulfillment of an order, when it is expanded."""
+    try:
+        order = db.customer_order(int(request.params.get('id')))
+    except (TypeError, ValueError):
+        order = None
+    if order is None:
+        abort(404)
+    lines = db(db.order_line.order_id == order.id).select(
+        db.order_line.product_id, db.order_line.quantity, db.order_line.unit_price).as_list()
+    return dict(ordered_items=nicefy(order.ordered_items),
+                fulfillment=nicefy(order.fulfillment),
+                lines=lines)
 
 @action('manage_products')
-@action.uses('manage_products.html', db, url_signer)
+@action.uses(instrument, 'manage_products.html', db, url_signer, assets)
 def manage_products():
     return dict(
         # This is the signed URL for the callback.
@@ -208,17 +416,40 @@ def manage_products():
         delete_url = URL('delete_product', signer=url_signer),
         edit_url = URL('edit_product', signer=url_signer),
         upload_url = URL('upload_image', signer=url_signer),
+        edits_url = URL('edit_products', signer=url_signer),
+        import_url = URL('import_products', signer=url_signer),
+        export_url = URL('export_products', signer=url_signer),
     )
 
 # This is our very first API function.
 @action('load_products')
-@action.uses(url_signer.verify(), db)
+@action.uses(instrument, url_signer.verify(), replicas)
 def load_products():
-    rows = db(db.product).select().as_list()
-    return dict(rows=rows)
+    """Returns the products.  With since=<revision>, returns only the products
+    changed after that revision, and the ids of the products deleted since.
+    The response contains the revision to use in the next call."""
+    try:
+        since = int(request.params.get('since'))
+    except (TypeError, ValueError):
+        since = None
+    version = catalog_version()
+    etag = etag_for('load_products', version, since)
+    if not_modified(etag):
+        return ""
+    if since is None:
+        rows = db(db.product).select().as_list()
+        deleted = []
+    else:
+        rows = db(db.product.revision > since).select().as_list()
+        deleted = [t.product_id for t in db(db.product_tombstone.revision > since).select(
+            db.product_tombstone.product_id)]
+    revision = max([version, since or 0] + [r['revision'] or 0 for r in rows])
+    return send_json(dict(rows=[with_image_urls(r) for r in rows],
+                          deleted=deleted,
+                          revision=revision), etag=etag)
 
 @action('add_product', method="POST")
-@action.uses(url_signer.verify(), db)
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
 def add_product():
     id = db.product.insert(
         product_name=request.json.get('product_name'),
@@ -226,31 +457,193 @@ def add_product():
         price=request.json.get('price'),
         description=request.json.get('description'),
     )
+    index_product(id, request.json.get('product_name'), request.json.get('description'))
+    # The version is bumped last, after the product is written (see stock.py).
+    stamp_products([id])
     return dict(id=id)
 
 @action('delete_product')
-@action.uses(url_signer.verify(), db)
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
 def delete_product():
     id = request.params.get('id')
     assert id is not None
-    db(db.product.id == id).delete()
+    deleted = db(db.product.id == id).delete()
+    unindex_product(id)
+    if deleted:
+        db.product_tombstone.insert(product_id=id, revision=bump_catalog_version())
     return "ok"
 
 @action('edit_product', method="POST")
-@action.uses(url_signer.verify(), db)
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
 def edit_product():
     id = request.json.get("id")
     field = request.json.get("field")
     value = request.json.get("value")
+    if field not in EDITABLE_FIELDS:
+        abort(400)
     db(db.product.id == id).update(**{field: value})
+    if field in ('product_name', 'description'):
+        reindex_product(id)
+    # The version is bumped last, after the product is locked (see stock.py).
+    stamp_products([id], stock_only=(field == 'quantity'))
     return "ok"
 
 @action('upload_image', method="POST")
-@action.uses(url_signer.verify(), db)
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
 def upload_image():
     product_id = request.json.get("product_id")
-    image = request.json.get("image")
-    db(db.product.id == product_id).update(image=image)
-    return "ok"
-
-
+    try:
+        key = store_image(request.json.get("image"))
+    except ValueError:
+        abort(400)
+    db(db.product.id == product_id).update(image=key)
+    stamp_products([product_id])
+    return dict(image=image_url(key), thumbnail=image_url(key, thumbnail=True))
+
+@action('edit_products', method="POST")
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
+def edit_products():
+    """Applies many {id, field, value} edits at once."""
+    try:
+        n = bulk.edit_rows(request.json.get('changes') or [])
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+    return dict(edited=n)
+
+@action('import_products', method="POST")
+@action.uses(instrument, url_signer.verify(), db, replicas.writes())
+def import_products():
+    """Imports products from a CSV (format=csv, the default) or JSONL
+    (format=jsonl) request body.  Rows with the id of an existing product
+    update it; the other rows are inserted."""
+    fmt = request.params.get('format', 'csv')
+    rows = bulk.parse_jsonl(request.body) if fmt == 'jsonl' else bulk.parse_csv(request.body)
+    try:
+        return bulk.import_rows(rows)
+    except (ValueError, TypeError, KeyError, csv.Error):
+        db.rollback()
+        abort(400)
+
+@action('export_products')
+@action.uses(instrument, url_signer.verify())
+def export_products():
+    """Streams all the products, as CSV (format=csv, the default) or JSONL."""
+    fmt = request.params.get('format', 'csv')
+    if fmt == 'jsonl':
+        response.headers['Content-Type'] = 'application/x-ndjson'
+        encode = bulk.export_jsonl
+    else:
+        response.headers['Content-Type'] = 'text/csv'
+        encode = bulk.export_csv
+    response.headers['Content-Disposition'] = 'attachment; filename="products.%s"' % fmt
+
+    primary = replicas.wants_primary()
+
+    def stream():
+        # The body is produced after the action returns, when the fixtures
+        # have already released their connections, so it takes its own.
+        uri = replicas.connect(primary)
+        try:
+            yield from encode(bulk.export_rows())
+        finally:
+            replicas.release(uri)
+
+    return stream()
+
+def serve_image(key, thumbnail=False):
+    """Streams an image from the image store.  Image files never change,
+    so the key doubles as ETag, and browsers can cache them forever."""
+    path = image_path(key, thumbnail=thumbnail)
+    if path is None:
+        abort(404)
+    etag = '"%s"' % key
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    if etag in request.headers.get('If-None-Match', ''):
+        response.status = 304
+        return ""
+    response.headers['Content-Type'] = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    response.headers['Content-Length'] = str(os.path.getsize(path))
+    return open(path, 'rb')
+
+@action('image/<key>')
+@action.uses(instrument)
+def image(key=None):
+    return serve_image(key)
+
+@action('thumbnail/<key>')
+@action.uses(instrument)
+def thumbnail(key=None):
+    return serve_image(key, thumbnail=True)
+
+@action('asset/<filename>')
+@action.uses(instrument)
+def asset(filename=None):
+    """Serves a static asset bundle (see assets.py), precompressed if the
+    browser accepts it.  Bundles are named after their content, so they
+    can be cached forever."""
+    found = asset_path(filename, request.headers.get('Accept-Encoding', ''))
+    if found is None:
+        abort(404)
+    path, content_type, encoding = found
+    etag = '"%s%s"' % (filename, '.' + encoding if encoding else '')
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if etag in request.headers.get('If-None-Match', ''):
+        response.status = 304
+        return ""
+    response.headers['Content-Type'] = content_type + '; charset=utf-8'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(os.path.getsize(path))
+    return open(path, 'rb')
+
+@action('metrics')
+def metrics_page():
+    """Returns the metrics of this process, in the Prometheus text format.
+    If METRICS_TOKEN is set, requires it as bearer token; otherwise, serves
+    only the requests from this host (by the address of the socket: the
+    X-Forwarded-For header, which request.remote_addr trusts, is forged
+    easily)."""
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != 'Bearer ' + METRICS_TOKEN:
+            abort(403)
+    elif request.environ.get('REMOTE_ADDR') not in ('127.0.0.1', '::1'):
+        abort(403)
+    catalog = cache_stats()
+    extra = dict(catalog_cache_hits=catalog['hits'],
+                 catalog_cache_misses=catalog['misses'])
+    store = session.params.storage
+    for k, v in getattr(store, 'stats', {}).items():
+        extra['session_cache_' + k] = v
+    for k, v in gate.status().items():
+        extra['admission_' + k] = v
+    for k, v in replicas.status().items():
+        extra['replicas_' + k] = v
+    for k, v in snapshot.stats.items():
+        extra['catalog_snapshot_' + k] = v
+    for k, v in startup.timings.items():
+        extra['startup_seconds_' + k] = round(v, 4)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return metrics.render(extra)
+
+@action('profile')
+@action.uses(instrument, db, session, auth.user)
+def profile():
+    """Samples the stacks of this worker for ?seconds=N, and returns them in
+    the collapsed-stack format, for flame graphs.  Only for the members of
+    the PROFILER_GROUP group."""
+    if PROFILER_GROUP not in groups.get(auth.user_id):
+        abort(403)
+    try:
+        seconds = min(float(request.params.get('seconds', 10)), PROFILE_MAX_SECONDS)
+    except ValueError:
+        abort(400)
+    counts = profiler.sample(seconds)
+    if counts is None:
+        abort(409, "Another profile is in progress")
+    response.headers['Content-Type'] = 'text/plain'
+    response.headers['Content-Disposition'] = 'attachment; filename="%s-%d.collapsed"' % (
+        APP_NAME, os.getpid())
+    return profiler.collapsed(counts)
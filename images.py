@@ -0,0 +1,125 @@
+"""
+This file implements the store for product images.
+
+The browser uploads images as data URLs.  We decode them once, on upload, and
+store the bytes in a file named after their sha256 hash, together with a
+thumbnail.  The product table only keeps the name of the file (the "key").
+As the content of a key never changes, the images can be served with an ETag
+equal to the key and with immutable cache headers.
+"""
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+import os
+import re
+
+from py4web import URL
+
+from .settings import IMAGE_FOLDER, THUMBNAIL_SIZE
+
+# Pillow is in requirements.txt; without it, the images are stored without
+# thumbnails, and the full image is served in their place.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+REGEX_DATA_URL = re.compile(r"^data:(image/[\w.+-]+);base64,(.*)$", re.DOTALL)
+REGEX_KEY = re.compile(r"^[0-9a-f]{64}\.\w{1,5}$")
+
+THUMBNAIL_FOLDER = os.path.join(IMAGE_FOLDER, "thumbnails")
+
+
+def parse_data_url(data_url):
+    """Returns the (mimetype, bytes) encoded in a data URL."""
+    m = REGEX_DATA_URL.match(data_url or "")
+    if m is None:
+        raise ValueError("Not an image data URL")
+    try:
+        data = base64.b64decode(m.group(2), validate=True)
+    except binascii.Error:
+        raise ValueError("Invalid base64 image data")
+    return m.group(1), data
+
+
+def image_path(key, thumbnail=False):
+    """Returns the path of the file for a key, or None if the key is not valid
+    or the file does not exist."""
+    if not key or not REGEX_KEY.match(key):
+        return None
+    if thumbnail:
+        path = os.path.join(THUMBNAIL_FOLDER, key[:2], key)
+        if os.path.exists(path):
+            return path
+    path = os.path.join(IMAGE_FOLDER, key[:2], key)
+    return path if os.path.exists(path) else None
+
+
+def _write_once(path, data):
+    """Writes data to path, unless the path already exists. Files are
+    written to a temporary name first, so readers never see partial files."""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _make_thumbnail(path, thumbnail_path):
+    if Image is None or os.path.exists(thumbnail_path):
+        return
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (thumbnail_path, os.getpid())
+    try:
+        with Image.open(path) as im:
+            fmt = im.format
+            im.thumbnail(THUMBNAIL_SIZE)
+            im.save(tmp_path, format=fmt)
+        os.replace(tmp_path, thumbnail_path)
+    except (OSError, ValueError):
+        # Not something Pillow can resize; the full image will be served.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store_image(data_url):
+    """Stores the image contained in a data URL, and returns its key."""
+    mimetype, data = parse_data_url(data_url)
+    ext = (mimetypes.guess_extension(mimetype) or ".bin").lstrip(".")
+    key = "%s.%s" % (hashlib.sha256(data).hexdigest(), ext)
+    path = os.path.join(IMAGE_FOLDER, key[:2], key)
+    _write_once(path, data)
+    _make_thumbnail(path, os.path.join(THUMBNAIL_FOLDER, key[:2], key))
+    return key
+
+
+def image_url(key, thumbnail=False):
+    """Returns the URL at which the image for a key is served."""
+    if not key:
+        return None
+    if key.startswith("data:"):
+        # Legacy row that still holds the data URL: it is sent once, as the
+        # image, the pages showing it when there is no thumbnail.
+        return None if thumbnail else key
+    return URL("thumbnail" if thumbnail else "image", key)
+
+
+def migrate_data_urls(db):
+    """Moves the images still stored as data URLs in db.product.image into
+    the image store.  Returns the number of products converted."""
+    n = 0
+    rows = db(db.product.image.startswith("data:")).select(db.product.id)
+    for row in rows:
+        p = db.product(row.id)
+        try:
+            key = store_image(p.image)
+        except ValueError:
+            continue
+        p.update_record(image=key)
+        n += 1
+    db.commit()
+    return n
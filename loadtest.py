@@ -0,0 +1,164 @@
+"""
+Load test of the storefront: concurrent clients browse the catalog and pay
+for products, against a running shop.
+
+    python apps/vue_shop/loadtest.py http://127.0.0.1:8000/vue_shop \\
+        --threads 20 --seconds 30
+
+Each client loads the index page for the signed URLs, and then loops,
+doing --reads get_products for each pay.  The shop should use the fake
+payment gateway (PAYMENT_GATEWAY = "fake").  Unless --no-seed is given,
+the test first adds --products products, with plenty of stock, through
+the product management API.
+
+At the end, it prints, for each API, the number of requests, the failed
+ones (by status), and the latency percentiles, as JSON.  Failed requests
+include those that hit "database is locked", which py4web reports as 500.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Returns the redirects as responses, rather than following them."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Client:
+    """An HTTP client that keeps its cookies.  With follow_redirects=False,
+    redirects are returned as they are, with their Location header."""
+
+    def __init__(self, base, follow_redirects=True):
+        self.base = base
+        self.origin = '/'.join(base.split('/', 3)[:3])
+        handlers = [urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())]
+        if not follow_redirects:
+            handlers.append(NoRedirect())
+        self.opener = urllib.request.build_opener(*handlers)
+
+    def open(self, path, body=None):
+        """Returns the status, headers and body of the response."""
+        url = path if path.startswith('http') else self.origin + path
+        data = None if body is None else json.dumps(body).encode('utf8')
+        req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with self.opener.open(req, timeout=60) as r:
+                return r.status, r.headers, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def request(self, path, body=None):
+        status, _, data = self.open(path, body)
+        return status, data
+
+    def urls(self, page):
+        status, body = self.request(self.base + '/' + page)
+        if status != 200:
+            raise RuntimeError("Cannot load %s: %s" % (page, status))
+        return dict(re.findall(r'let (\w+_url) = "([^"]*)"', body.decode('utf8')))
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.failures = {}
+
+    def record(self, name, status, elapsed):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if not 200 <= status < 400:
+                failures = self.failures.setdefault(name, {})
+                failures[str(status)] = failures.get(str(status), 0) + 1
+
+    def report(self, seconds):
+        result = {}
+        for name, times in sorted(self.latencies.items()):
+            times = sorted(times)
+            pick = lambda p: round(1000 * times[min(len(times) - 1, int(p * len(times)))], 1)
+            result[name] = dict(
+                requests=len(times),
+                per_second=round(len(times) / seconds, 1),
+                failed=self.failures.get(name, {}),
+                p50_ms=pick(0.50), p95_ms=pick(0.95), p99_ms=pick(0.99),
+            )
+        return result
+
+
+def seed(base, n):
+    """Adds n products, with plenty of stock."""
+    client = Client(base)
+    urls = client.urls('manage_products')
+    for i in range(n):
+        status, _ = client.request(urls['add_url'], dict(
+            product_name='Load test product %d' % i, quantity=1000000,
+            price=1 + i % 50, description='Product added by the load test'))
+        if status != 200:
+            raise RuntimeError("Cannot add products: %s" % status)
+
+
+def timed(stats, name, client, path, body=None):
+    t0 = time.time()
+    status, data = client.request(path, body)
+    stats.record(name, status, time.time() - t0)
+    return status, data
+
+
+def run_client(base, stop, stats, reads):
+    client = Client(base)
+    urls = client.urls('index')
+    products = []
+    while not stop.is_set():
+        for _ in range(reads):
+            status, data = timed(stats, 'get_products', client, urls['products_url'] +
+                                 '&sort=' + random.choice(['id', 'name', 'price']))
+            if status == 200 and not products:
+                products = [p['id'] for p in json.loads(data)['products'] if p['quantity']]
+        if not products:
+            continue
+        items = [dict(product_id=random.choice(products), quantity=1)]
+        timed(stats, 'pay', client, urls['pay_url'], dict(items=items, fulfillment={}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the shop.")
+    parser.add_argument('base', help="URL of the app, e.g. http://127.0.0.1:8000/vue_shop")
+    parser.add_argument('--threads', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--reads', type=int, default=5, help="get_products per pay")
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--no-seed', action='store_true')
+    args = parser.parse_args()
+    base = args.base.rstrip('/')
+    if not args.no_seed:
+        seed(base, args.products)
+    stats, stop = Stats(), threading.Event()
+    threads = [threading.Thread(target=run_client, args=(base, stop, stats, args.reads), daemon=True)
+               for _ in range(args.threads)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    print(json.dumps(stats.report(time.time() - t0), indent=2))
+
+
+if __name__ == '__main__':
+    main()
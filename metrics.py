@@ -0,0 +1,232 @@
+"""
+This file implements the performance instrumentation of the actions.
+
+The instrument fixture, used by every action in controllers.py, records for
+each action:
+
+- the number of requests, by status, and a histogram of their latency;
+- the number of database queries, and the time spent in them;
+- the size of the responses;
+- the time spent calling external services (the payment gateway, the
+  session storage), reported by the code that calls them with timer().
+
+The metrics are served in the Prometheus text format by the metrics action.
+Requests slower than SLOW_REQUEST_SECONDS are logged, with the SQL they
+issued and the time of each statement.  Requests with the parameter
+__profile=<PROFILE_TOKEN> return their cProfile statistics (see
+profiler.py).
+
+The metrics are kept in each process: with several processes, each of them
+is a separate Prometheus target.
+"""
+
+import bisect
+import contextlib
+import logging
+import re
+import threading
+import time
+
+from py4web import request, response
+from py4web.core import Fixture, dumps
+from pydal.helpers.classes import ExecutionHandler
+
+from . import settings
+from .profiler import RequestProfile
+
+logger = logging.getLogger("py4web:" + settings.APP_NAME)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Statements kept per request for the slow-request log.
+MAX_LOGGED_STATEMENTS = 50
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Histogram:
+    """A Prometheus histogram, with the LATENCY_BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            cumulative += n
+            yield '%s_bucket{%sle="%s"} %d' % (name, labels, bound, cumulative)
+        yield '%s_sum{%s} %f' % (name, labels.rstrip(','), self.sum)
+        yield '%s_count{%s} %d' % (name, labels.rstrip(','), self.count)
+
+
+# action -> Histogram of the request latency
+_latency = {}
+# (action, status) -> number of requests
+_requests = {}
+# action -> [queries, db seconds, response bytes]
+_totals = {}
+# service -> Histogram of the call latency
+_external = {}
+
+
+def _observe_external(service, seconds):
+    with _lock:
+        _external.setdefault(service, Histogram()).observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(service):
+    """Times the block as a call to an external service, both in the metrics
+    and in the current request, if any."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        _observe_external(service, elapsed)
+        current = getattr(_local, 'request', None)
+        if current is not None:
+            current['external'][service] = current['external'].get(service, 0) + elapsed
+
+
+class QueryTimer(ExecutionHandler):
+    """Times the database queries of the instrumented requests."""
+
+    def before_execute(self, command):
+        self.t0 = time.perf_counter()
+
+    def after_execute(self, command):
+        current = getattr(_local, 'request', None)
+        if current is not None:
+            elapsed = time.perf_counter() - self.t0
+            current['queries'] += 1
+            current['db_seconds'] += elapsed
+            if len(current['sql']) < MAX_LOGGED_STATEMENTS:
+                current['sql'].append((elapsed, command))
+
+
+def install(db):
+    """Makes db report its queries to the instrumentation.  The handler is
+    added to the adapter of db only: DAL.execution_handlers is shared by
+    all the DALs of the process, those of the other apps included."""
+    if QueryTimer not in db._adapter.execution_handlers:
+        db._adapter.execution_handlers.append(QueryTimer)
+
+
+def _response_size(output):
+    """Returns the size of the body; that of streamed responses is their
+    Content-Length, if they set it."""
+    if isinstance(output, (bytes, str)):
+        return len(output)
+    try:
+        return int(response.headers.get('Content-Length') or 0)
+    except ValueError:
+        return 0
+
+
+class Instrumentation(Fixture):
+    """Records the performance of the requests.  Use it as first fixture,
+    so that it measures the others as well."""
+
+    # Called also when a fixture fails.
+    is_hook = True
+
+    def on_request(self, context):
+        _local.request = dict(start=time.perf_counter(), queries=0, db_seconds=0.0,
+                              sql=[], external={}, profile=None)
+        if settings.PROFILE_TOKEN and request.query.get('__profile') == settings.PROFILE_TOKEN:
+            _local.request['profile'] = RequestProfile()
+            _local.request['profile'].start()
+
+    def on_success(self, context):
+        status = context['status'] if context['status'] != 200 else response.status_code
+        profile = _local.request and _local.request['profile']
+        if profile is not None:
+            # Returns the profile instead of the response, without the
+            # headers that describe the response (see responses.py).
+            context['output'] = profile.stop()
+            for name in ('Content-Encoding', 'ETag', 'Vary'):
+                response.headers.pop(name, None)
+            response.headers['Content-Type'] = 'text/plain'
+            response.status = 200
+        elif isinstance(context['output'], (dict, list)):
+            # Serialized here, as py4web would after the fixtures, so that
+            # its size is known.
+            response.headers.setdefault('Content-Type', 'application/json')
+            context['output'] = dumps(context['output'])
+        self._record(status, _response_size(context['output']))
+
+    def on_error(self, context):
+        profile = getattr(_local, 'request', None) and _local.request['profile']
+        if profile is not None:
+            profile.stop()
+        # abort() raises an HTTPError, with the status it was given.
+        self._record(getattr(context.get('exception'), 'status_code', 500), 0)
+
+    def _record(self, status, size):
+        current = getattr(_local, 'request', None)
+        if current is None:
+            return
+        _local.request = None
+        elapsed = time.perf_counter() - current['start']
+        route = request.environ.get('bottle.route')
+        route = route.rule if route is not None else request.path
+        with _lock:
+            _latency.setdefault(route, Histogram()).observe(elapsed)
+            _requests[(route, status)] = _requests.get((route, status), 0) + 1
+            totals = _totals.setdefault(route, [0, 0.0, 0])
+            totals[0] += current['queries']
+            totals[1] += current['db_seconds']
+            totals[2] += size
+        if settings.SLOW_REQUEST_SECONDS and elapsed > settings.SLOW_REQUEST_SECONDS:
+            logger.warning(
+                "Slow request %s %s: %.3fs, status %s, %d queries in %.3fs, %s\n%s",
+                request.method, request.fullpath, elapsed, status,
+                current['queries'], current['db_seconds'],
+                ', '.join('%s %.3fs' % kv for kv in current['external'].items()) or 'no external calls',
+                '\n'.join('  %.4fs %s' % s for s in current['sql']))
+
+
+instrument = Instrumentation()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render(extra=None):
+    """Returns the metrics in the Prometheus text format.  extra is a
+    dictionary from metric name to value, for gauges computed elsewhere."""
+    prefix = re.sub(r'\W', '_', settings.APP_NAME)
+    lines = []
+    with _lock:
+        lines.append('# TYPE %s_request_seconds histogram' % prefix)
+        for route, h in sorted(_latency.items()):
+            lines.extend(h.lines(prefix + '_request_seconds', 'action="%s",' % _label(route)))
+        lines.append('# TYPE %s_requests_total counter' % prefix)
+        for (route, status), n in sorted(_requests.items()):
+            lines.append('%s_requests_total{action="%s",status="%s"} %d' % (
+                prefix, _label(route), status, n))
+        for i, (name, fmt) in enumerate([('db_queries_total', '%d'),
+                                         ('db_seconds_total', '%f'),
+                                         ('response_bytes_total', '%d')]):
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for route, totals in sorted(_totals.items()):
+                lines.append(('%s_%s{action="%s"} ' + fmt) % (prefix, name, _label(route), totals[i]))
+        lines.append('# TYPE %s_external_seconds histogram' % prefix)
+        for service, h in sorted(_external.items()):
+            lines.extend(h.lines(prefix + '_external_seconds', 'service="%s",' % _label(service)))
+    for name, value in sorted((extra or {}).items()):
+        if value is not None:
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            lines.append('%s_%s %s' % (prefix, name, value))
+    return '\n'.join(lines) + '\n'
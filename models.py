@@ -3,7 +3,8 @@ This file defines the database models
 """
 
 import datetime
-from .common import db, Field, auth
+from .common import db, Field, auth, migrate, schema_unchanged
+from . import startup
 from pydal.validators import *
 
 
@@ -13,15 +14,66 @@ def get_user_email():
 def get_time():
     return datetime.datetime.utcnow()
 
+def ensure_index(table, name, *fields):
+    """Creates an index on the table, unless it exists already, or the
+    schema is unchanged since the last migration (see startup.py)."""
+    if schema_unchanged:
+        return
+    if db._dbname in ('sqlite', 'postgres'):
+        sql = db._adapter.dialect.create_index(name, table, [f._rname for f in fields])
+        db.executesql(sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+        return
+    try:
+        table.create_index(name, *fields)
+    except RuntimeError:
+        pass # The index exists already.
+
 # Product table.
 db.define_table('product',
     Field('product_name'),
     Field('quantity', 'integer'),
     Field('price', 'float'),
-    Field('image', 'text'), # Data URL for the image.
+    Field('image', 'text'), # Key of the image in the image store (see images.py).
     Field('description', 'text'),
+    Field('revision', 'integer', default=0), # Catalog version of the last change.
 )
 db.product.id.readable = db.product.id.writable = False
+ensure_index(db.product, 'product_revision_idx', db.product.revision)
+# For the catalog sorted by name or price (see catalog.py).
+ensure_index(db.product, 'product_name_idx', db.product.product_name, db.product.id)
+ensure_index(db.product, 'product_price_idx', db.product.price, db.product.id)
+
+# Deleted products, so that clients syncing the product list incrementally
+# can remove them.
+db.define_table('product_tombstone',
+    Field('product_id', 'integer'),
+    Field('revision', 'integer'),
+)
+ensure_index(db.product_tombstone, 'product_tombstone_revision_idx',
+             db.product_tombstone.revision)
+
+# Version of the catalog, bumped at every change of the products; it keys
+# the cached catalog pages (see catalog_cache.py).  The content version is
+# bumped by the changes other than of the stock; it keys the catalog
+# snapshots (see snapshot.py).
+db.define_table('catalog_state',
+    Field('version', 'integer', default=0),
+    Field('content_version', 'integer', default=0),
+)
+if db(db.catalog_state).isempty():
+    db.catalog_state.insert(version=0)
+
+# Inverted index used to search products when FTS5 is not available
+# (see search.py).
+db.define_table('product_search_token',
+    Field('token'),
+    Field('product_id', 'integer'),
+    Field('weight', 'integer'),
+)
+ensure_index(db.product_search_token, 'product_search_token_token_idx',
+             db.product_search_token.token, db.product_search_token.product_id)
+ensure_index(db.product_search_token, 'product_search_token_product_idx',
+             db.product_search_token.product_id)
 
 db.define_table('customer_order',
     Field('order_date', default=get_time),
@@ -30,6 +82,69 @@ db.define_table('customer_order',
     Field('paid', 'boolean', default=False),
     Field('created_on', 'datetime', default=get_time),
     Field('paid_on', 'datetime'),
+    Field('payment_session_id'), # Id of the checkout session at the gateway.
+    # pending, ready, failed, reaped (abandoned, see reaper.py), or expired
+    # (the checkout session expired, see webhooks.py).
+    Field('payment_status', default='pending'),
+)
+ensure_index(db.customer_order, 'customer_order_paid_created_idx',
+             db.customer_order.paid, db.customer_order.created_on)
+# For the reaper, which skips the orders already reaped.
+ensure_index(db.customer_order, 'customer_order_reaper_idx', db.customer_order.paid,
+             db.customer_order.payment_status, db.customer_order.created_on)
+ensure_index(db.customer_order, 'customer_order_created_idx', db.customer_order.created_on)
+# For the sales reports (see orders.py).
+ensure_index(db.customer_order, 'customer_order_paid_on_idx', db.customer_order.paid_on)
+
+# Lines of the orders, with the price at the time of purchase (see orders.py).
+db.define_table('order_line',
+    Field('order_id', 'reference customer_order', ondelete='CASCADE'),
+    Field('product_id', 'integer'),
+    Field('quantity', 'integer'),
+    Field('unit_price', 'float'),
 )
+ensure_index(db.order_line, 'order_line_order_idx', db.order_line.order_id)
+ensure_index(db.order_line, 'order_line_product_idx', db.order_line.product_id)
+
+# Number and revenue of the orders paid each day, kept up to date as orders
+# are paid, for the order browser (see orders.py).
+db.define_table('daily_sales',
+    Field('day', 'date', unique=True),
+    Field('orders', 'integer', default=0),
+    Field('revenue', 'double', default=0),
+)
+
+# Quantities taken out of the stock for an order (see stock.py).
+db.define_table('stock_reservation',
+    Field('order_id', 'reference customer_order', ondelete='CASCADE'),
+    Field('product_id', 'integer'),
+    Field('quantity', 'integer'),
+    Field('status', default='held'), # held, committed, or released.
+    Field('created_on', 'datetime', default=get_time),
+    Field('expires_on', 'datetime'),
+)
+ensure_index(db.stock_reservation, 'stock_reservation_order_idx',
+             db.stock_reservation.order_id)
+ensure_index(db.stock_reservation, 'stock_reservation_expiry_idx',
+             db.stock_reservation.status, db.stock_reservation.expires_on)
+
+# Events received from the payment webhook; the unique event_id makes sure
+# each event is applied once (see webhooks.py).
+db.define_table('payment_event',
+    Field('event_id', unique=True),
+    Field('event_type'),
+    Field('order_id', 'integer'),
+    Field('received_on', 'datetime', default=get_time),
+    Field('processed', 'boolean', default=False),
+)
+ensure_index(db.payment_event, 'payment_event_processed_idx',
+             db.payment_event.processed, db.payment_event.id)
+
+# Server side sessions (see common.py) are looked up by key at every request.
+if 'py4web_session' in db.tables:
+    ensure_index(db.py4web_session, 'py4web_session_rkey_idx', db.py4web_session.rkey)
+    ensure_index(db.py4web_session, 'py4web_session_expires_idx', db.py4web_session.expires_on)
 
 db.commit()
+if migrate:
+    startup.record_schema()
@@ -0,0 +1,245 @@
+"""
+This file manages the lines of the orders.
+
+The items of an order are stored as rows of the order_line table, with the
+unit price at the time of purchase, so that reports (sales per product,
+revenue) and the stock restoration of abandoned orders are computed in SQL
+rather than by parsing the ordered_items JSON of every order.
+
+Orders created before order_line existed are backfilled from their
+ordered_items by a task, run once after the upgrade, rather than at the
+startup of every worker:
+
+    py4web call apps vue_shop.orders.backfill_order_lines
+
+The number and revenue of the orders paid each day are kept in the
+daily_sales table, updated by record_paid() whenever orders are paid, so
+that the order browser does not aggregate the orders at every view.
+rebuild_daily_sales() recomputes the table from the orders; run it after
+the backfill:
+
+    py4web call apps vue_shop.orders.rebuild_daily_sales
+
+The order browser pages through the orders, newest first, with keyset
+cursors on (created_on, id), which the indexes on customer_order serve
+directly for every filter.  The number of matching orders is counted only
+every ORDER_COUNT_EXPIRATION seconds for a given filter.
+"""
+
+import datetime
+import json
+
+from .common import db, cache, logger
+from .catalog import encode_cursor, decode_cursor
+from . import stock
+from .settings import ORDERS_PAGE_SIZE, ORDER_COUNT_EXPIRATION
+
+
+def insert_order_lines(order_id, items, products):
+    """Inserts the lines of an order, with a single bulk insert.  products
+    is the dictionary from product id to product read for the cart."""
+    db.order_line.bulk_insert([
+        dict(order_id=order_id, product_id=product_id, quantity=n,
+             unit_price=products[product_id].price)
+        for product_id, n in stock.cart_quantities(items).items()
+    ])
+
+
+def items_quantities(order):
+    """Returns a dictionary from product id to quantity, read from the
+    ordered_items of an order, as the orders created before the order lines
+    have no lines; it is empty if they cannot be read."""
+    try:
+        return stock.cart_quantities(json.loads(order.ordered_items or '[]'))
+    except (ValueError, TypeError, KeyError):
+        logger.warning("Cannot read the items of order %s", order.id)
+        return {}
+
+
+def backfill_order_lines(batch_size=1000):
+    """Creates the lines of the orders that have none, from their
+    ordered_items.  As the price at the time of purchase is not known, the
+    current price of the product is used.  Returns the number of orders
+    backfilled."""
+    with_lines = db(db.order_line)._select(db.order_line.order_id, distinct=True)
+    total, last_id = 0, 0
+    while True:
+        orders = db((db.customer_order.id > last_id) &
+                    ~db.customer_order.id.belongs(with_lines)).select(
+            db.customer_order.id, db.customer_order.ordered_items,
+            orderby=db.customer_order.id, limitby=(0, batch_size))
+        if not orders:
+            break
+        lines = []
+        for o in orders:
+            lines.extend(dict(order_id=o.id, product_id=product_id, quantity=n)
+                         for product_id, n in items_quantities(o).items())
+        prices = {p.id: p.price for p in db(db.product.id.belongs(
+            {l['product_id'] for l in lines})).select(db.product.id, db.product.price)}
+        for l in lines:
+            l['unit_price'] = prices.get(l['product_id'])
+        db.order_line.bulk_insert(lines)
+        db.commit()
+        total += len(orders)
+        last_id = orders.last().id
+    return total
+
+
+def ordered_quantities(order_ids):
+    """Returns a dictionary from product id to the total quantity ordered by
+    the given orders."""
+    total = db.order_line.quantity.sum()
+    rows = db(db.order_line.order_id.belongs(order_ids)).select(
+        db.order_line.product_id, total, groupby=db.order_line.product_id)
+    return {r.order_line.product_id: r[total] for r in rows}
+
+
+def sales_by_product(start=None, end=None):
+    """Returns, for each product, the quantity sold and the revenue of the
+    orders paid between start and end."""
+    quantity = db.order_line.quantity.sum()
+    revenue = (db.order_line.quantity * db.order_line.unit_price).sum()
+    q = (db.order_line.order_id == db.customer_order.id) & (db.customer_order.paid == True)
+    if start is not None:
+        q &= db.customer_order.paid_on >= start
+    if end is not None:
+        q &= db.customer_order.paid_on < end
+    rows = db(q).select(db.order_line.product_id, quantity, revenue,
+                        groupby=db.order_line.product_id)
+    return [dict(product_id=r.order_line.product_id,
+                 quantity=r[quantity] or 0,
+                 revenue=r[revenue] or 0)
+            for r in rows]
+
+
+def total_revenue(start=None, end=None):
+    """Returns the revenue of the orders paid between start and end."""
+    return sum(s['revenue'] for s in sales_by_product(start, end))
+
+
+# Daily sales.
+
+def order_totals(order_ids):
+    """Returns a dictionary from order id to the total of the order."""
+    total = (db.order_line.quantity * db.order_line.unit_price).sum()
+    rows = db(db.order_line.order_id.belongs(order_ids)).select(
+        db.order_line.order_id, total, groupby=db.order_line.order_id)
+    return {r.order_line.order_id: r[total] or 0 for r in rows}
+
+
+def add_daily_sales(day, orders, revenue):
+    """Adds orders and revenue to the sales of day.  The first sale of the
+    day inserts its row; if another transaction inserts it at the same time,
+    the insert fails on the unique day, and is rolled back to a savepoint
+    (so that the transaction can go on), and the row is updated instead."""
+
+    def update():
+        return db(db.daily_sales.day == day).update(
+            orders=db.daily_sales.orders + orders,
+            revenue=db.daily_sales.revenue + revenue)
+
+    if update():
+        return
+    db.executesql("SAVEPOINT daily_sales_insert;")
+    try:
+        db.daily_sales.insert(day=day, orders=orders, revenue=revenue)
+    except Exception:
+        db.executesql("ROLLBACK TO SAVEPOINT daily_sales_insert;")
+        update()
+    else:
+        db.executesql("RELEASE SAVEPOINT daily_sales_insert;")
+
+
+def record_paid(order_ids, paid_on):
+    """Adds the orders, which have just been paid on paid_on, to the daily
+    sales."""
+    if order_ids:
+        add_daily_sales(paid_on.date(), len(order_ids),
+                        sum(order_totals(order_ids).values()))
+
+
+def rebuild_daily_sales():
+    """Recomputes the daily sales from the paid orders.  Returns the number
+    of days with sales."""
+    paid_on = db.customer_order.paid_on
+    day = [paid_on.year(), paid_on.month(), paid_on.day()]
+    orders = db.customer_order.id.count(distinct=True)
+    revenue = (db.order_line.quantity * db.order_line.unit_price).sum()
+    q = (db.customer_order.paid == True) & (paid_on != None)
+    counts = db(q).select(*(day + [orders]), groupby=day)
+    revenues = {(r[day[0]], r[day[1]], r[day[2]]): r[revenue] for r in db(
+        q & (db.order_line.order_id == db.customer_order.id)).select(
+        *(day + [revenue]), groupby=day)}
+    db(db.daily_sales).delete()
+    for r in counts:
+        key = (r[day[0]], r[day[1]], r[day[2]])
+        db.daily_sales.insert(day=datetime.date(*key), orders=r[orders],
+                              revenue=revenues.get(key) or 0)
+    db.commit()
+    return len(counts)
+
+
+def daily_sales(start=None, end=None):
+    """Returns the daily sales between the dates start and end, included."""
+    q = db.daily_sales.id > 0
+    if start is not None:
+        q &= db.daily_sales.day >= start
+    if end is not None:
+        q &= db.daily_sales.day <= end
+    return db(q).select(orderby=db.daily_sales.day).as_list()
+
+
+# Order browser.
+
+def order_query(paid=None, start=None, end=None):
+    """Returns the query of the orders with the given paid status, created
+    between the dates start and end, included."""
+    q = db.customer_order.id > 0
+    if paid is not None:
+        q &= db.customer_order.paid == paid
+    if start is not None:
+        q &= db.customer_order.created_on >= datetime.datetime.combine(start, datetime.time())
+    if end is not None:
+        q &= db.customer_order.created_on < datetime.datetime.combine(
+            end + datetime.timedelta(days=1), datetime.time())
+    return q
+
+
+def order_count(paid=None, start=None, end=None):
+    """Returns the number of orders matching the filter, as counted at most
+    ORDER_COUNT_EXPIRATION seconds ago."""
+    key = "order_count:%s:%s:%s" % (paid, start, end)
+    return cache.get(key, lambda: db(order_query(paid, start, end)).count(),
+                     ORDER_COUNT_EXPIRATION)
+
+
+def order_page(paid=None, start=None, end=None, cursor=None, limit=None):
+    """Returns (orders, next_cursor) for one page of the orders matching the
+    filter, newest first.  The orders carry their total, but not their
+    ordered_items and fulfillment, which are read by order_details.  Raises
+    ValueError if the cursor is not valid."""
+    limit = limit or ORDERS_PAGE_SIZE
+    q = order_query(paid, start, end)
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            created_on = datetime.datetime.fromisoformat(position[0])
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        q &= ((db.customer_order.created_on < created_on) |
+              ((db.customer_order.created_on == created_on) &
+               (db.customer_order.id < position[1])))
+    orders = db(q).select(
+        db.customer_order.id, db.customer_order.created_on, db.customer_order.paid,
+        db.customer_order.paid_on, db.customer_order.payment_status,
+        orderby=~db.customer_order.created_on | ~db.customer_order.id,
+        limitby=(0, limit + 1)).as_list()
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1]['created_on'].isoformat(), orders[-1]['id'])
+    totals = order_totals([o['id'] for o in orders])
+    for o in orders:
+        o['total'] = totals.get(o['id'], 0)
+    return orders, next_cursor
+
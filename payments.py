@@ -0,0 +1,170 @@
+"""
+This file defines the payment gateways used to create checkout sessions.
+
+The gateway is chosen by settings.PAYMENT_GATEWAY:
+- "stripe" uses Stripe Checkout, through a pooled, keep-alive HTTP client
+  with the timeout and retries given in the settings; the keys, and the
+  stripe library, slow to import, are read and configured when first
+  needed, rather than at the startup of each worker.
+- "fake" creates session ids locally, after an optional simulated delay, so
+  that the whole checkout flow can be exercised (and load tested) offline;
+  the fake_checkout action stands for the checkout page of the gateway, and
+  sends the customer straight to the success URL.
+
+In "queued" PAYMENT_MODE, sessions are created by a pool of background
+threads, and the client polls for the session id; the pay action then does
+not wait for the gateway.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import db, logger
+from . import settings
+from . import stock
+from .metrics import timer
+
+
+class PaymentError(Exception):
+    """Raised when the gateway cannot create a checkout session."""
+
+
+class FakeGateway:
+    """Gateway that creates checkout sessions locally, without any network."""
+
+    public_key = ""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def create_checkout_session(self, line_items, success_url, cancel_url, order_id):
+        with timer('fake_gateway'):
+            if self.delay:
+                time.sleep(self.delay)
+            return "cs_fake_%s_%s" % (order_id, uuid.uuid4().hex)
+
+    @staticmethod
+    def order_of(session_id):
+        """Returns the id of the order of a fake session id, or None."""
+        try:
+            return int(session_id.split('_')[2])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+
+class StripeGateway:
+    """Gateway that creates Stripe Checkout sessions.  The keys are read from
+    private/stripe_keys.json when first needed, so that a worker starts even
+    before the file is deployed."""
+
+    def __init__(self, timeout=10, max_retries=2):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.key_info = None
+        self.stripe = None
+
+    def _keys(self):
+        with self.lock:
+            if self.key_info is None:
+                self.key_info = read_stripe_keys()
+            return self.key_info
+
+    @property
+    def public_key(self):
+        return self._keys()['test_public_key']
+
+    def _stripe(self):
+        """Returns the stripe module, importing and configuring it on first
+        use."""
+        private_key = self._keys()['test_private_key']
+        with self.lock:
+            if self.stripe is None:
+                import requests
+                import stripe
+                try:
+                    from stripe import RequestsClient
+                except ImportError:
+                    from stripe.http_client import RequestsClient
+                stripe.api_key = private_key
+                stripe.max_network_retries = self.max_retries
+                # A single session keeps the connections to Stripe alive, and
+                # pools them among the threads of the worker.
+                stripe.default_http_client = RequestsClient(timeout=self.timeout,
+                                                            session=requests.Session())
+                self.stripe = stripe
+            return self.stripe
+
+    def create_checkout_session(self, line_items, success_url, cancel_url, order_id):
+        stripe = self._stripe()
+        # The session expires with the stock reservation, so that abandoned
+        # orders cannot be paid after they are reaped.  Stripe wants between
+        # 30 minutes and 24 hours.
+        expires_at = int(time.time()) + 60 * min(24 * 60, max(30, settings.RESERVATION_MINUTES))
+        try:
+            with timer('stripe'):
+                stripe_session = stripe.checkout.Session.create(
+                    payment_method_types=['card'],
+                    line_items=line_items,
+                    mode='payment',
+                    expires_at=expires_at,
+                    client_reference_id=str(order_id),
+                    success_url=success_url,
+                    cancel_url=cancel_url,
+                )
+        except stripe.error.StripeError as e:
+            raise PaymentError(str(e))
+        return stripe_session.id
+
+
+def read_stripe_keys():
+    """Reads the stripe keys."""
+    with open(os.path.join(settings.APP_FOLDER, 'private', 'stripe_keys.json'), 'r') as f:
+        return json.load(f)
+
+
+def make_gateway():
+    if settings.PAYMENT_GATEWAY == "fake":
+        return FakeGateway(delay=settings.FAKE_GATEWAY_DELAY)
+    return StripeGateway(timeout=settings.PAYMENT_TIMEOUT,
+                         max_retries=settings.PAYMENT_MAX_RETRIES)
+
+
+gateway = make_gateway()
+
+
+# Queued mode.
+
+_executor = None
+
+
+def _create_session_in_background(order_id, line_items, success_url, cancel_url):
+    # This runs in its own thread, so it needs its own db connection.
+    db._adapter.reconnect()
+    try:
+        session_id = gateway.create_checkout_session(
+            line_items, success_url, cancel_url, order_id)
+        db(db.customer_order.id == order_id).update(
+            payment_session_id=session_id, payment_status='ready')
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error("Could not create the checkout session of order %s: %s", order_id, e)
+        stock.release(order_id)
+        db(db.customer_order.id == order_id).update(payment_status='failed')
+        db.commit()
+    finally:
+        db._adapter.close()
+
+
+def queue_checkout_session(order_id, line_items, success_url, cancel_url):
+    """Creates the checkout session of the order in the background."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.PAYMENT_QUEUE_WORKERS)
+    _executor.submit(_create_session_in_background,
+                     order_id, line_items, success_url, cancel_url)
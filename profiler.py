@@ -0,0 +1,83 @@
+"""
+This file implements the profiling of a live worker.
+
+sample() profiles the whole process for a number of seconds: the thread
+that calls it (that of the profile action) reads the stack of every other
+thread every SAMPLE_INTERVAL seconds, and counts how many times each stack
+was seen.  The result is written in
+the collapsed-stack format ("thread;outer;...;inner count" per line), which
+flamegraph.pl and speedscope turn into a flame graph.  Nothing runs, and
+nothing is paid, when no sampling is in progress.
+
+RequestProfile profiles a single request with cProfile; the instrument
+fixture (see metrics.py) uses it for requests that carry
+__profile=<PROFILE_TOKEN>, and returns the statistics instead of the
+response.
+"""
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+from .settings import SAMPLE_INTERVAL
+
+# Only one sampling at a time.
+_sampling = threading.Lock()
+
+
+def _frame_label(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def sample(seconds, interval=None):
+    """Samples the stacks of all the other threads for the given seconds.
+    Returns a Counter from collapsed stack to number of samples, or None if
+    another sampling is in progress."""
+    interval = interval or SAMPLE_INTERVAL
+    if not _sampling.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts = collections.Counter()
+        end = time.time() + seconds
+        while time.time() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident) or str(ident))
+                counts[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return counts
+    finally:
+        _sampling.release()
+
+
+def collapsed(counts):
+    """Returns counts in the collapsed-stack format."""
+    return ''.join('%s %d\n' % (stack, n) for stack, n in sorted(counts.items()))
+
+
+class RequestProfile:
+    """Profiles the code run by the current thread between start() and
+    stop()."""
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self, sort='cumulative', limit=60):
+        """Stops the profile, and returns its statistics as text."""
+        self.profile.disable()
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
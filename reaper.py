@@ -0,0 +1,234 @@
+"""
+This file implements the reaper of abandoned orders.
+
+An order is abandoned if it is still unpaid when its stock reservations
+expire (RESERVATION_MINUTES after its creation), or, if it holds none,
+ABANDONED_ORDER_MINUTES after its creation: the customer never completed
+the payment, and the Stripe session has expired.  The reaper returns the
+stock reserved by these orders, and marks them as reaped (payment_status);
+the orders are kept, so that a payment that still arrives for one of
+them, e.g. by a late webhook, is recorded, and logged as an error, as its
+stock is gone: see check_late_payments().  It works in batches of
+REAPER_BATCH_SIZE reservations or orders, each in its own short
+transaction, so it never holds the write lock for long.
+
+The reaper runs as a Celery task when USE_CELERY is set (see tasks.py);
+otherwise, the reaper fixture starts it in a background thread, with the
+first request served by the process, so that the processes that serve no
+requests (py4web call, the benchmark tools) do not run it.  Of the
+processes of a machine, only the one holding the lock file
+DB_FOLDER/reaper.lock reaps; with several machines, use Celery, whose beat
+schedules the task once.  It can also be run by hand with:
+
+    py4web call apps vue_shop.reaper.reap_abandoned_orders
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from py4web.core import Fixture
+
+from .common import db, logger
+from .models import get_time
+from . import settings
+from . import stock
+from .orders import items_quantities, ordered_quantities
+
+# The payment_status of the reaped orders, and of the orders whose checkout
+# session expired (see webhooks.py).
+REAPED = 'reaped'
+EXPIRED = 'expired'
+
+# fcntl is not available on Windows, where every process reaps.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def reservations_since():
+    """Returns when the first stock reservation was made, or None if none
+    was: the orders created since then have reserved their stock."""
+    first = db.stock_reservation.id.min()
+    first = db(db.stock_reservation).select(first).first()[first]
+    return db.stock_reservation(first).created_on if first else None
+
+
+def legacy_quantities(order_ids):
+    """Returns the quantities ordered by orders that have no reservations,
+    as they were created before stock reservations existed.  The orders
+    created since are not legacy, even without reservations: their stock
+    was never taken.  The quantities come from the order lines, or, for the
+    orders not backfilled yet, from their ordered_items."""
+    reserved = db(db.stock_reservation.order_id.belongs(order_ids))._select(
+        db.stock_reservation.order_id, distinct=True)
+    q = db.customer_order.id.belongs(order_ids) & ~db.customer_order.id.belongs(reserved)
+    since = reservations_since()
+    if since is not None:
+        q &= db.customer_order.created_on < since
+    legacy = db(q)._select(db.customer_order.id)
+    quantities = ordered_quantities(legacy)
+    with_lines = db(db.order_line.order_id.belongs(legacy))._select(
+        db.order_line.order_id, distinct=True)
+    for order in db(q & ~db.customer_order.id.belongs(with_lines)).select(
+            db.customer_order.id, db.customer_order.ordered_items):
+        for product_id, n in items_quantities(order).items():
+            quantities[product_id] = quantities.get(product_id, 0) + n
+    return quantities
+
+
+def _mark_reaped(ids):
+    # The order may have been paid since we read it.
+    return db(db.customer_order.id.belongs(ids) & (db.customer_order.paid == False) &
+              ~db.customer_order.payment_status.belongs([REAPED, EXPIRED])).update(
+        payment_status=REAPED)
+
+
+def reap_expired_batch(now, batch_size):
+    """Reaps the orders of up to batch_size held reservations expired
+    before now.  Returns the number of reservations read, and of orders
+    reaped."""
+    expired = db((db.stock_reservation.status == stock.HELD) &
+                 (db.stock_reservation.expires_on < now)).select(
+        db.stock_reservation.order_id, limitby=(0, batch_size))
+    if not expired:
+        return 0, 0
+    order_ids = {r.order_id for r in expired}
+    paid = [o.id for o in db(db.customer_order.id.belongs(order_ids) &
+                             (db.customer_order.paid == True)).select(db.customer_order.id)]
+    # The stock of a paid order is sold, even if its reservation was not
+    # committed yet.
+    stock.commit(paid)
+    ids = sorted(order_ids.difference(paid))
+    stock.release_orders(ids)
+    reaped = _mark_reaped(ids)
+    db.commit()
+    return len(expired), reaped
+
+
+def reap_batch(cutoff, batch_size):
+    """Reaps up to batch_size orders created before cutoff that hold no
+    stock: those created before the stock reservations, and those whose
+    reservations were released.  Returns the number of orders read, and
+    reaped."""
+    held = db(db.stock_reservation.status == stock.HELD)._select(
+        db.stock_reservation.order_id)
+    orders = db((db.customer_order.paid == False) &
+                ~db.customer_order.payment_status.belongs([REAPED, EXPIRED]) &
+                (db.customer_order.created_on < cutoff) &
+                ~db.customer_order.id.belongs(held)).select(
+        db.customer_order.id,
+        orderby=db.customer_order.created_on, limitby=(0, batch_size))
+    if not orders:
+        return 0, 0
+    ids = [o.id for o in orders]
+    stock.restore_quantities(legacy_quantities(ids))
+    reaped = _mark_reaped(ids)
+    db.commit()
+    return len(orders), reaped
+
+
+def check_late_payments(order_ids):
+    """Logs the orders, just paid, that had been reaped, or whose checkout
+    session had expired: their stock was returned, and may have been sold
+    again, so they need to be checked by hand.  They are the paid orders
+    with payment_status 'reaped' or 'expired'."""
+    if not order_ids:
+        return
+    for order in db(db.customer_order.id.belongs(order_ids) &
+                    db.customer_order.payment_status.belongs([REAPED, EXPIRED])).select(
+            db.customer_order.id, db.customer_order.payment_status):
+        logger.error("Order %s was paid after %s: its stock had been returned", order.id,
+                     'it was reaped' if order.payment_status == REAPED else 'its session expired')
+
+
+def reap_abandoned_orders(minutes=None, batch_size=None):
+    """Reaps all the abandoned orders.  Returns the number of orders reaped."""
+    # Derived here, rather than in settings.py, so that it follows a
+    # RESERVATION_MINUTES set in the private settings.
+    minutes = (minutes or settings.ABANDONED_ORDER_MINUTES
+               or settings.RESERVATION_MINUTES + 10)
+    batch_size = batch_size or settings.REAPER_BATCH_SIZE
+    now = get_time()
+    cutoff = now - datetime.timedelta(minutes=minutes)
+    total = 0
+    try:
+        for reap_batch_of, before in ((reap_expired_batch, now), (reap_batch, cutoff)):
+            while True:
+                n, reaped = reap_batch_of(before, batch_size)
+                total += reaped
+                if n < batch_size:
+                    break
+    except Exception:
+        db.rollback()
+        raise
+    if total:
+        logger.info("Reaped %d abandoned orders", total)
+    return total
+
+
+REAPER_THREAD_NAME = "%s-reaper" % settings.APP_NAME
+LOCK_FILE = os.path.join(settings.DB_FOLDER, 'reaper.lock')
+
+_lock_file = None
+
+
+def _is_reaper():
+    """Tells if this process is the one that reaps, taking the lock file if
+    it is free (its holder may have exited)."""
+    global _lock_file
+    if fcntl is None or _lock_file is not None:
+        return True
+    f = open(LOCK_FILE, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _lock_file = f  # Kept open, and so locked, until the process exits.
+    return True
+
+
+def _reaper_loop(interval):
+    while True:
+        time.sleep(interval)
+        if not _is_reaper():
+            continue
+        # This runs in its own thread, so it needs its own db connection.
+        db._adapter.reconnect()
+        try:
+            reap_abandoned_orders()
+        except Exception as e:
+            logger.error("The reaper failed: %s", e)
+        finally:
+            db._adapter.close()
+
+
+def start_reaper(interval=None):
+    """Starts the reaper thread, unless it is already running (as happens
+    when the app is reloaded)."""
+    interval = interval or settings.REAPER_INTERVAL
+    if any(t.name == REAPER_THREAD_NAME for t in threading.enumerate()):
+        return
+    t = threading.Thread(target=_reaper_loop, args=(interval,),
+                         name=REAPER_THREAD_NAME, daemon=True)
+    t.start()
+
+
+class Reaper(Fixture):
+    """Starts the reaper thread with the first request of the process,
+    unless Celery runs the reaper, or REAPER_INTERVAL is 0."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = settings.USE_CELERY or not settings.REAPER_INTERVAL
+
+    def on_request(self, context):
+        if not self.started:
+            self.started = True
+            start_reaper()
+
+
+reaper = Reaper()
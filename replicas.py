@@ -0,0 +1,227 @@
+"""
+This file implements the routing of the reads to the read replicas.
+
+The read-only actions (the catalog, the order browser, the product list of
+the product manager, and the export) use the replicas fixture instead of
+db.  For each request, it picks the next of the DB_READ_URIS, in turn,
+and points db, in the thread serving the request, at a connection to that
+replica: the code that queries db (catalog.py, orders.py, ...) then reads
+from the replica unchanged.  The requests go to the primary, DB_URI,
+instead:
+
+- when there are no replicas, or none is available: a replica that fails
+  to connect, or to run a query, is skipped for REPLICA_RETRY_SECONDS;
+- for READ_YOUR_WRITES_SECONDS after the same client wrote: the actions
+  that write use replicas.writes(), which sets a cookie, so that an admin
+  sees the products they have just edited, and a customer the stock they
+  have just bought, even if the replicas lag behind.
+
+The catalog version (see catalog_cache.py) is read, and cached, for each
+database separately, so that a lagging replica does not make the primary
+look older; as a catalog version always describes the same catalog, the
+pages cached for a version are the same whichever database built them.
+
+For trying the replicas locally, with SQLite, replicate() keeps copies of
+the SQLite primary up to date, e.g. with DB_READ_URIS = ["sqlite://
+replica1.db", "sqlite://replica2.db"] in settings_private.py:
+
+    py4web call apps vue_shop.replicas.replicate --args '{"seconds": 1}'
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import threadsafevariable
+from py4web import request, response
+from py4web.core import Fixture, ICECUBE
+from pydal import DAL
+from pydal._globals import THREAD_LOCAL
+
+from .common import db, after_connection
+from . import settings
+
+logger = logging.getLogger("py4web:" + settings.APP_NAME)
+
+PRIMARY = 'primary'
+
+
+class ReadYourWrites(Fixture):
+    """Sends the reads of the client to the primary for a while, after a
+    successful write."""
+
+    def __init__(self, replicas):
+        super().__init__()
+        self.replicas = replicas
+
+    def on_success(self, context):
+        if self.replicas.uris:
+            seconds = settings.READ_YOUR_WRITES_SECONDS
+            response.set_cookie(self.replicas.cookie, str(int(time.time() + seconds)),
+                                max_age=seconds, path='/', httponly=True, samesite='Lax')
+
+
+class Replicas(Fixture):
+    """Connects db, for the request, to a read replica, or to the primary."""
+
+    def __init__(self, db, uris):
+        super().__init__()
+        self.db = db
+        # The db fixture comes first, and commits the primary connection
+        # once the replica connection is given back.
+        self.__prerequisites__ = [db]
+        self.uris = list(uris)
+        self.cookie = settings.APP_NAME + '_primary_until'
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.dals = {}  # Replica URI -> DAL, created on first use.
+        self.down = {}  # Replica URI -> time until which it is skipped.
+        self.stats = collections.Counter()
+        # The connection of db that connect() replaced, in each thread.
+        self.saved = threading.local()
+
+    def _dal(self, uri):
+        with self.lock:
+            replica = self.dals.get(uri)
+        if replica is None:
+            # Only the connections are used: the tables are those of db.
+            replica = DAL(uri, folder=settings.DB_FOLDER, pool_size=self.db._adapter.pool_size,
+                          migrate_enabled=False, attempts=1, after_connection=after_connection)
+            with self.lock:
+                replica = self.dals.setdefault(uri, replica)
+        return replica
+
+    def _next(self):
+        """Returns the next available replica, or None."""
+        now = time.time()
+        with self.lock:
+            for _ in range(len(self.uris)):
+                uri = self.uris[self.turn % len(self.uris)]
+                self.turn += 1
+                if self.down.get(uri, 0) <= now:
+                    return uri
+        return None
+
+    def fail(self, uri, error):
+        """Skips the replica for REPLICA_RETRY_SECONDS."""
+        logger.warning("Read replica %s failed, skipped for %ss: %s",
+                       uri.split('@')[-1], settings.REPLICA_RETRY_SECONDS, error)
+        with self.lock:
+            self.down[uri] = time.time() + settings.REPLICA_RETRY_SECONDS
+            self.stats['failures'] += 1
+
+    def wants_primary(self):
+        """Tells if the client of the request wrote recently."""
+        try:
+            return float(request.get_cookie(self.cookie) or 0) > time.time()
+        except ValueError:
+            return False
+
+    def _thread_connection(self):
+        """Returns the connection of db in this thread, without opening one."""
+        return getattr(THREAD_LOCAL, self.db._adapter._connection_uname_, None)
+
+    def connect(self, primary=False):
+        """Points db, in this thread, at a connection to the next available
+        replica, or, if primary or there is none, to the primary.  Returns
+        the URI of the replica, or None for the primary.  The connection db
+        had is put back by release()."""
+        previous = self.saved.previous = self._thread_connection()
+        for _ in range(0 if primary else len(self.uris)):
+            uri = self._next()
+            if uri is None:
+                break
+            replica = None
+            try:
+                replica = self._dal(uri)
+                replica._adapter.reconnect()
+                self.db._adapter.set_connection(replica._adapter.connection)
+            except Exception as e:
+                self.db._adapter.set_connection(previous)
+                if replica is not None:
+                    replica._adapter.close('rollback')
+                self.fail(uri, e)
+                continue
+            with self.lock:
+                self.stats['replica_reads'] += 1
+            return uri
+        if previous is None:
+            self.db._adapter.get_connection()
+        with self.lock:
+            self.stats['primary_reads'] += 1
+        return None
+
+    def release(self, uri, action='commit'):
+        """Gives back the connection taken by connect(), and points db at the
+        connection it had before, if any; that one is left to its owner, the
+        db fixture."""
+        previous, self.saved.previous = getattr(self.saved, 'previous', None), None
+        if uri is not None:
+            self.db._adapter.set_connection(previous)
+            self.dals[uri]._adapter.close(action)
+        elif previous is None:
+            self.db._adapter.close(action)
+
+    def current(self):
+        """Returns the URI of the replica that db reads from in this request,
+        or PRIMARY."""
+        return (self.local.uri if self.is_valid() else None) or PRIMARY
+
+    def writes(self):
+        """Returns a fixture, for the actions that write, that sends the
+        reads of the client to the primary for READ_YOUR_WRITES_SECONDS."""
+        return ReadYourWrites(self)
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return dict(self.stats, configured=len(self.uris),
+                        available=sum(1 for u in self.uris if self.down.get(u, 0) <= now))
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.uri = self.connect(primary=not self.uris or self.wants_primary())
+        threadsafevariable.ThreadSafeVariable.restore(ICECUBE)
+
+    def on_success(self, context):
+        self.release(self.local.uri, 'commit')
+
+    def on_error(self, context):
+        uri = self.local.uri
+        error = context.get('exception')
+        if uri is not None and isinstance(error, getattr(
+                self.db._adapter.driver, 'OperationalError', ())):
+            self.fail(uri, error)
+        self.release(uri, 'rollback')
+
+
+replicas = Replicas(db, settings.DB_READ_URIS)
+
+
+def _sqlite_path(uri):
+    assert uri.startswith('sqlite://'), "replicate() copies SQLite databases only"
+    return os.path.join(settings.DB_FOLDER, uri[len('sqlite://'):])
+
+
+def replicate(seconds=1, once=False):
+    """Copies the SQLite primary to the SQLite replicas of DB_READ_URIS,
+    every `seconds` (which is then the replication lag), until interrupted,
+    or once.  For tests: real replicas are kept in sync by the database."""
+    source = _sqlite_path(settings.DB_URI)
+    targets = [_sqlite_path(uri) for uri in settings.DB_READ_URIS]
+    while True:
+        t0 = time.time()
+        with contextlib.closing(sqlite3.connect(source)) as src:
+            for target in targets:
+                with contextlib.closing(sqlite3.connect(
+                        target, timeout=settings.DB_BUSY_TIMEOUT)) as dst:
+                    src.backup(dst)
+        logger.info("Replicated %s to %d replicas in %.3fs",
+                    source, len(targets), time.time() - t0)
+        if once:
+            return
+        time.sleep(max(0, seconds - (time.time() - t0)))
@@ -0,0 +1,91 @@
+"""
+This file contains helpers for conditional and compressed JSON responses.
+
+Catalog responses carry an ETag computed from the catalog version and the
+request parameters, so a client that already has the current content gets
+a 304 without the response being rebuilt.  The ETag is weak: the same
+content is sent with gzip, br, or no content coding, whose bodies differ,
+and a strong ETag would have to differ with them.  Large responses are
+compressed with brotli (if installed) or gzip, according to the
+Accept-Encoding of the request; the compressed bodies are kept in
+common.cache, keyed by ETag, so that they are compressed only once.
+"""
+
+import gzip
+import hashlib
+import json
+
+from py4web import request, response
+
+from .common import cache
+from .settings import COMPRESSION_THRESHOLD
+
+# brotli is optional.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def etag_for(*parts):
+    """Returns a weak ETag for the given parts."""
+    h = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf8'))
+    return 'W/"%s"' % h.hexdigest()
+
+
+def _opaque(etag):
+    # If-None-Match uses the weak comparison, which ignores the W/ prefix.
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(etag):
+    """Sets the ETag of the response, and returns True, after setting the
+    status to 304, if the client already has this version."""
+    response.headers['ETag'] = etag
+    # The client may keep the response, but must check it is still current.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    # The body depends on the Accept-Encoding, for the 304 as well.
+    response.headers['Vary'] = 'Accept-Encoding'
+    if _opaque(etag) in [_opaque(t) for t in request.headers.get('If-None-Match', '').split(',')]:
+        response.status = 304
+        return True
+    return False
+
+
+def _accepted_encoding():
+    accepted = request.headers.get('Accept-Encoding', '')
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def _encode(value, encoding):
+    if isinstance(value, bytes):
+        body = value
+    else:
+        body = json.dumps(value, separators=(',', ':'), default=str).encode('utf8')
+    if encoding is None or len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+    if encoding == 'br':
+        return brotli.compress(body, quality=5), encoding
+    return gzip.compress(body, compresslevel=6), encoding
+
+
+def send_json(value, etag=None):
+    """Returns value serialized as JSON (or value itself, if it is JSON
+    already, as bytes), compressed if large enough and the client accepts
+    it.  If etag is given, the encoded body is cached."""
+    encoding = _accepted_encoding()
+    if etag is None:
+        body, used = _encode(value, encoding)
+    else:
+        body, used = cache.get("json:%s:%s" % (etag, encoding),
+                               lambda: _encode(value, encoding))
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if used:
+        response.headers['Content-Encoding'] = used
+    return body
@@ -0,0 +1,199 @@
+"""
+This file maintains the full-text index used to search products.
+
+On SQLite we use an FTS5 virtual table, product_fts, whose rowid is the
+product id.  On other databases (or if SQLite was built without FTS5) we
+fall back to an inverted index kept in the product_search_token table,
+with one row per (token, product).  Either way, the index is updated by the
+actions that modify products, in the same transaction, and it can be
+rebuilt from scratch with:
+
+    py4web call apps vue_shop.search.rebuild_index
+
+Searches match every word of the query as a prefix (so that type-ahead
+works), and results are ranked with matches in the product name counting
+more than matches in the description.  While the index is incomplete, as
+after an upgrade, until rebuild_index is run, the products are searched
+with LIKE instead: slower, and not ranked, but complete.
+"""
+
+import re
+import time
+
+from .common import db, logger, migrate
+
+NAME_WEIGHT = 10
+DESCRIPTION_WEIGHT = 1
+
+# Seconds between the checks of an incomplete index.
+INDEX_CHECK_SECONDS = 60
+
+REGEX_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return REGEX_TOKEN.findall((text or "").lower())
+
+
+def _create_fts_table():
+    """Creates the FTS5 table if needed, when the migrations are enabled.
+    Returns (available, created)."""
+    if db._dbname != 'sqlite':
+        return False, False
+    exists = db.executesql(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_fts';")
+    if exists:
+        return True, False
+    if not migrate:
+        return False, False
+    try:
+        db.executesql(
+            "CREATE VIRTUAL TABLE product_fts USING fts5("
+            "product_name, description, tokenize='unicode61 remove_diacritics 2');")
+    except Exception as e:
+        logger.warning("FTS5 not available, using the fallback search index: %s", e)
+        return False, False
+    return True, True
+
+
+# Index maintenance.
+
+def index_product(product_id, product_name, description):
+    """Adds, or replaces, a product in the index."""
+    unindex_product(product_id)
+    if USE_FTS:
+        db.executesql(
+            "INSERT INTO product_fts(rowid, product_name, description) VALUES (?, ?, ?);",
+            placeholders=(int(product_id), product_name or "", description or ""))
+    else:
+        weights = {}
+        for t in tokenize(description):
+            weights[t] = weights.get(t, 0) + DESCRIPTION_WEIGHT
+        for t in tokenize(product_name):
+            weights[t] = weights.get(t, 0) + NAME_WEIGHT
+        db.product_search_token.bulk_insert([
+            dict(token=t, product_id=product_id, weight=w) for t, w in weights.items()
+        ])
+
+
+def unindex_product(product_id):
+    """Removes a product from the index."""
+    if USE_FTS:
+        db.executesql("DELETE FROM product_fts WHERE rowid = ?;",
+                      placeholders=(int(product_id),))
+    else:
+        db(db.product_search_token.product_id == product_id).delete()
+
+
+def reindex_product(product_id):
+    """Reads a product from the db, and updates its entry in the index."""
+    p = db.product(product_id)
+    if p is None:
+        unindex_product(product_id)
+    else:
+        index_product(p.id, p.product_name, p.description)
+
+
+def rebuild_index(batch_size=1000):
+    """Rebuilds the whole index from the product table."""
+    global _index_checked_on
+    if USE_FTS:
+        db.executesql("DELETE FROM product_fts;")
+    else:
+        db(db.product_search_token).delete()
+    last_id = 0
+    while True:
+        rows = db(db.product.id > last_id).select(
+            db.product.id, db.product.product_name, db.product.description,
+            orderby=db.product.id, limitby=(0, batch_size))
+        for p in rows:
+            index_product(p.id, p.product_name, p.description)
+        if len(rows) < batch_size:
+            break
+        last_id = rows.last().id
+    db.commit()
+    _index_checked_on = None
+
+
+def _index_complete():
+    """Tells if every product is in the index."""
+    if USE_FTS:
+        indexed = db.executesql("SELECT COUNT(*) FROM product_fts;")[0][0]
+    else:
+        indexed = db(db.product_search_token).count(
+            db.product_search_token.product_id, distinct=True)
+    return indexed >= db(db.product).count()
+
+
+def _index_ready():
+    """Tells if the index can be used, checking again, at most every
+    INDEX_CHECK_SECONDS, an index that was incomplete."""
+    global _index_checked_on
+    if _index_checked_on is None:
+        return True
+    if time.time() - _index_checked_on < INDEX_CHECK_SECONDS:
+        return False
+    _index_checked_on = time.time()
+    if not _index_complete():
+        return False
+    _index_checked_on = None
+    return True
+
+
+# Searching.
+
+def _search_like(tokens, offset, limit):
+    """Returns the ids of the products containing every token, by id."""
+    q = db.product.id > 0
+    for t in tokens:
+        q &= db.product.product_name.contains(t) | db.product.description.contains(t)
+    rows = db(q).select(db.product.id, orderby=db.product.id,
+                        limitby=(offset, offset + limit))
+    return [r.id for r in rows]
+
+
+def search_products(text, offset=0, limit=20):
+    """Returns the ids of the products matching text, best matches first."""
+    tokens = tokenize(text)
+    if not tokens:
+        return []
+    if not _index_ready():
+        return _search_like(tokens, offset, limit)
+    if USE_FTS:
+        match = " ".join('"%s"*' % t for t in tokens)
+        rows = db.executesql(
+            "SELECT rowid FROM product_fts WHERE product_fts MATCH ? "
+            "ORDER BY bm25(product_fts, %d, %d) LIMIT ? OFFSET ?;"
+            % (NAME_WEIGHT, DESCRIPTION_WEIGHT),
+            placeholders=(match, int(limit), int(offset)))
+        return [r[0] for r in rows]
+    scores = None
+    for t in tokens:
+        token_scores = {}
+        rows = db(db.product_search_token.token.startswith(t)).select(
+            db.product_search_token.product_id, db.product_search_token.weight)
+        for r in rows:
+            token_scores[r.product_id] = token_scores.get(r.product_id, 0) + r.weight
+        if scores is None:
+            scores = token_scores
+        else:
+            scores = {k: v + token_scores[k] for k, v in scores.items() if k in token_scores}
+        if not scores:
+            return []
+    ranked = sorted(scores, key=lambda k: (-scores[k], k))
+    return ranked[offset:offset + limit]
+
+
+# the index is not rebuilt here, by every worker that starts: when the
+# table is new, or the fallback index is empty, run rebuild_index once;
+# until then, the searches use LIKE
+USE_FTS, _created = _create_fts_table()
+if _created:
+    db.commit()
+# When the index was last found incomplete, or None if it is complete.
+_index_checked_on = None
+if (_created or not USE_FTS and db(db.product_search_token).isempty()) \
+        and not db(db.product).isempty():
+    _index_checked_on = time.time()
+    logger.warning("The search index is empty, and the searches use LIKE until "
+                   "py4web call apps vue_shop.search.rebuild_index is run")
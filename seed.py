@@ -0,0 +1,94 @@
+"""
+This file fills the database with a synthetic catalog and order history,
+for benchmarks (see benchmark.py) and for trying the app with realistic
+volumes.  Use it on a development database:
+
+    py4web call apps vue_shop.seed.seed --args '{"products": 5000, "orders": 100000}'
+
+The data is the same for the same arguments: products are named from a
+small vocabulary, so that searches find them, and have `stock` items each
+(a million by default);
+orders are spread over the last `days` days, and a fraction `paid` of them
+are paid.  The products are added through the bulk import, which indexes
+them for search, and the daily sales are rebuilt at the end.
+"""
+
+import datetime
+import json
+import random
+import time
+
+from .common import db
+from . import bulk
+from .stock import RELEASED
+from .orders import rebuild_daily_sales
+
+COLORS = ['red', 'blue', 'green', 'black', 'white', 'yellow', 'orange', 'purple']
+MATERIALS = ['cotton', 'wool', 'leather', 'steel', 'wooden', 'ceramic', 'glass', 'paper']
+THINGS = ['shirt', 'scarf', 'bag', 'mug', 'lamp', 'chair', 'notebook', 'clock',
+          'bowl', 'hat', 'wallet', 'vase']
+
+# Words that appear in the product names, for search queries.
+WORDS = COLORS + MATERIALS + THINGS
+
+
+def product_rows(n, rng, stock=1000000):
+    for i in range(n):
+        color, material, thing = rng.choice(COLORS), rng.choice(MATERIALS), rng.choice(THINGS)
+        yield dict(
+            product_name='%s %s %s %d' % (color.capitalize(), material, thing, i),
+            quantity=stock,
+            price=rng.randint(100, 20000) / 100.0,
+            description='A %s %s, made of %s.' % (color, thing, material),
+        )
+
+
+def seed(products=1000, orders=10000, days=90, paid=0.7, random_seed=1, chunk_size=1000,
+         stock=1000000):
+    """Adds the products, with stock items each, and the orders.  Returns
+    the number of each added, and the seconds taken."""
+    rng = random.Random(random_seed)
+    t0 = time.time()
+    bulk.import_rows(product_rows(products, rng, stock))
+    db.commit()
+    prices = {r.id: r.price for r in db(db.product).select(db.product.id, db.product.price)}
+    product_ids = list(prices)
+    now = datetime.datetime.utcnow()
+    for start in range(0, orders if product_ids else 0, chunk_size):
+        new_orders, items_of = [], []
+        for _ in range(min(chunk_size, orders - start)):
+            created_on = now - datetime.timedelta(seconds=rng.randint(0, days * 86400))
+            is_paid = rng.random() < paid
+            items = [dict(product_id=i, quantity=rng.randint(1, 3))
+                     for i in rng.sample(product_ids, min(len(product_ids), rng.randint(1, 3)))]
+            new_orders.append(dict(
+                order_date=str(created_on),
+                ordered_items=json.dumps(items),
+                fulfillment=json.dumps(dict(name='Customer %d' % rng.randint(1, 10 ** 6))),
+                paid=is_paid,
+                created_on=created_on,
+                paid_on=created_on + datetime.timedelta(minutes=rng.randint(1, 30)) if is_paid else None,
+                payment_session_id='cs_seed_%d' % rng.getrandbits(64),
+                payment_status='ready',
+            ))
+            items_of.append(items)
+        ids = db.customer_order.bulk_insert(new_orders)
+        db.order_line.bulk_insert([
+            dict(order_id=order_id, product_id=it['product_id'], quantity=it['quantity'],
+                 unit_price=prices[it['product_id']])
+            for order_id, items in zip(ids, items_of) for it in items
+        ])
+        # The stock of the unpaid orders is recorded as already released, so
+        # that the reaper does not take them for legacy orders, and return
+        # stock they never took.
+        db.stock_reservation.bulk_insert([
+            dict(order_id=order_id, product_id=it['product_id'], quantity=it['quantity'],
+                 status=RELEASED, expires_on=now)
+            for order_id, items, order in zip(ids, items_of, new_orders)
+            if not order['paid'] for it in items
+        ])
+        db.commit()
+    rebuild_daily_sales()
+    result = dict(products=products, orders=orders, seconds=round(time.time() - t0, 1))
+    print(json.dumps(result))
+    return result
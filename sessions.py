@@ -0,0 +1,196 @@
+"""
+This file implements the session storage of the app.
+
+The sessions are kept in a storage (the database, redis, or memcache, as
+set by SESSION_TYPE), with an in-process LRU tier of SESSION_CACHE_SIZE
+sessions in front of it:
+
+- a session is written to the storage only if its content changed; if only
+  its timestamp changed, which happens when it is saved to refresh its
+  expiration, the write is delayed, and done by a background thread every
+  SESSION_FLUSH_INTERVAL seconds, unless the session was changed in the
+  storage in the meantime;
+- reads of a session that is in the LRU do not touch the storage for
+  SESSION_CACHE_TTL seconds.  The default is short, as with several
+  processes a session changed by another process (a logout, a login, a
+  change of groups) is ignored for as long; with 0, every read goes to the
+  storage, and the LRU only saves the writes.
+
+benchmark() measures the session reads and writes per second, directly
+from the storage, and through the LRU tier without and with the TTL; from
+the command line:
+
+    py4web call apps vue_shop.sessions.benchmark
+"""
+
+import collections
+import json
+import threading
+import time
+import uuid
+
+from . import settings
+from .metrics import timer
+
+
+def _content(value):
+    """Returns the content of the serialized session value, without the
+    timestamp that is refreshed at every save."""
+    if isinstance(value, bytes):
+        value = value.decode('utf8')
+    try:
+        data = json.loads(value)
+    except (TypeError, ValueError):
+        return value
+    if isinstance(data, dict):
+        data.pop('timestamp', None)
+    return data
+
+
+def _str(key):
+    return key.decode('utf8') if isinstance(key, bytes) else key
+
+
+class CachedStore:
+    """A session storage, with the get(key) and set(key, value, expiration)
+    methods that py4web expects, that keeps the sessions most recently used
+    in memory in front of another storage."""
+
+    def __init__(self, storage, size=None, ttl=None, flush_interval=None, db=None):
+        """storage is the storage of the sessions; db, if given, is the
+        database used by it, to which the background thread connects."""
+        self.storage = storage
+        self.size = size or settings.SESSION_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else settings.SESSION_CACHE_TTL
+        self.flush_interval = flush_interval if flush_interval is not None else settings.SESSION_FLUSH_INTERVAL
+        self.db = db
+        if hasattr(storage, '__prerequisites__'):
+            self.__prerequisites__ = storage.__prerequisites__
+        self._lock = threading.Lock()
+        # key -> (value, content, read_on)
+        self._entries = collections.OrderedDict()
+        # key -> (value, expiration, content), waiting to be written.
+        self._pending = {}
+        self._timer = None
+        self.stats = dict(hits=0, misses=0, writes=0, skipped=0, delayed=0)
+
+    def _remember(self, key, value, content):
+        self._entries[key] = (value, content, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        # py4web reads the sessions by bytes key, and writes them by str key.
+        key, storage_key = _str(key), key
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[2] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+        with timer('session'):
+            value = self.storage.get(storage_key)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                if value is not None and _content(value) == pending[2]:
+                    # Not flushed yet: the storage has an older timestamp.
+                    value = pending[0]
+                else:
+                    # Changed by another process: its version wins.
+                    del self._pending[key]
+            if value is not None:
+                self._remember(key, value, _content(value))
+        return value
+
+    def set(self, key, value, expiration=None):
+        key = _str(key)
+        content = _content(value)
+        with self._lock:
+            entry = self._entries.get(key)
+            unchanged = entry is not None and entry[1] == content
+            self._remember(key, value, content)
+            if unchanged:
+                if expiration or key in self._pending:
+                    # Only the expiration needs refreshing: write it later.
+                    self._pending[key] = (value, expiration, content)
+                    self.stats['delayed'] += 1
+                    self._schedule_flush()
+                else:
+                    self.stats['skipped'] += 1
+                return
+            self._pending.pop(key, None)
+            self.stats['writes'] += 1
+        with timer('session'):
+            self.storage.set(key, value, expiration)
+
+    def _schedule_flush(self):
+        # Called with the lock held.
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes the delayed sessions to the storage, except those changed
+        there since, e.g. by another process.  Returns how many it wrote."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+        written = 0
+        for key, (value, expiration, content) in pending.items():
+            current = self.storage.get(key)
+            if current is not None and _content(current) == content:
+                self.storage.set(key, value, expiration)
+                written += 1
+        return written
+
+    def _flush_in_background(self):
+        from .common import logger
+
+        if self.db is not None:
+            # This runs in its own thread, so it needs its own db connection.
+            self.db._adapter.reconnect()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Could not write the sessions: %s", e)
+        finally:
+            if self.db is not None:
+                self.db._adapter.close()
+
+
+def benchmark(n=5000, sessions=1000):
+    """Reads n sessions, and saves them unchanged, directly from the storage
+    and through the LRU tier; prints and returns the operations per second.
+    Use it on a development database: it writes test sessions."""
+    from .common import db, session
+
+    store = session.params.storage
+    storage = store.storage if isinstance(store, CachedStore) else store
+    keys = [str(uuid.uuid4()) for _ in range(sessions)]
+    for key in keys:
+        storage.set(key, json.dumps(dict(uuid=key, timestamp=time.time())))
+    db.commit()
+
+    result = dict(requests=n, sessions=sessions)
+    ttl = max(settings.SESSION_CACHE_TTL, 1)
+    for name, s in (('storage', storage),
+                    ('cached', CachedStore(storage, size=sessions, ttl=0)),
+                    ('cached_ttl', CachedStore(storage, size=sessions, ttl=ttl))):
+        t0 = time.time()
+        for i in range(n):
+            key = keys[i % sessions]
+            s.get(key)
+            s.set(key, json.dumps(dict(uuid=key, timestamp=time.time())))
+        result['%s_per_second' % name] = round(n / max(time.time() - t0, 1e-9))
+        if isinstance(s, CachedStore):
+            result['%s_stats' % name] = s.stats
+
+    if hasattr(storage, 'table'):
+        db(storage.table.rkey.belongs(keys)).delete()
+        db.commit()
+    print(json.dumps(result))
+    return result
@@ -0,0 +1,2 @@
+PAYMENT_GATEWAY = "fake"
+PAYMENT_WEBHOOK_SECRET = "whsec_test"
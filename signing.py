@@ -0,0 +1,105 @@
+"""
+This file implements a URL signer that does not use the session.
+
+py4web's URLSigner(session) signs URLs with a key kept in the session, so
+verifying a signature means loading the session.  The storefront APIs
+(get_products, checkout, pay, ...) are instead signed with a server secret:
+the signature is an HMAC of the path, of the signed variables, and of an
+expiration time carried in the URL, and is verified without any I/O, by
+any worker.
+
+The secrets are the URL_SIGNING_KEYS (or, if there are none, the session
+secret).  URLs are signed with the first key, and accepted if signed with
+any of them, so a key can be rotated by putting the new key first, and
+removing the old one once the URLs it signed have expired.
+
+StatelessURLSigner can be used in place of URLSigner:
+
+    url_signer = StatelessURLSigner()
+
+    @action('index')
+    @action.uses(url_signer)
+    def index():
+        return dict(products_url=URL('get_products', signer=url_signer))
+
+    @action('get_products')
+    @action.uses(url_signer.verify())
+    def get_products():
+        ...
+"""
+
+import hashlib
+import hmac
+import os
+import time
+
+from py4web import HTTP, request
+from py4web.core import Fixture
+
+from . import settings
+
+
+def key_id(key):
+    """Returns the short id by which signatures refer to a key."""
+    return hashlib.sha256(key.encode('utf8')).hexdigest()[:8]
+
+
+class StatelessURLVerifier(Fixture):
+    """Checks the signature of the request URL."""
+
+    def __init__(self, url_signer):
+        super().__init__()
+        self.url_signer = url_signer
+
+    def on_request(self, context):
+        signature = request.query.get('_signature')
+        if signature is None or not self.url_signer.check(
+                request.fullpath, request.query, signature):
+            raise HTTP(403)
+        # We remove the signature, not to pollute the request.
+        del request.query['_signature']
+
+
+class StatelessURLSigner(Fixture):
+    """Signs URLs with a server secret, and an embedded expiration time."""
+
+    def __init__(self, keys=None, lifespan=None, variables_to_sign=None):
+        """keys is the list of secrets, the first one of which is used to
+        sign; lifespan is the validity of the signatures, in seconds."""
+        super().__init__()
+        keys = keys or settings.URL_SIGNING_KEYS or [settings.SESSION_SECRET_KEY]
+        self.keys = {key_id(k): k.encode('utf8') for k in keys}
+        self.signing_key_id = key_id(keys[0])
+        self.lifespan = lifespan or settings.URL_SIGNATURE_LIFESPAN
+        self.variables_to_sign = variables_to_sign or []
+        assert '_signature' not in self.variables_to_sign
+
+    def _digest(self, key, url, variables, expires):
+        message = "\n".join([url, str(expires)] + [
+            "%s=%s" % (v, variables.get(v)) for v in self.variables_to_sign])
+        return hmac.new(key, message.encode('utf8'), hashlib.sha256).hexdigest()
+
+    def sign(self, url, variables):
+        """Adds the signature of url to its variables."""
+        assert '_signature' not in variables
+        url = os.environ.get('PY4WEB_URL_PREFIX', '') + url
+        expires = int(time.time() + self.lifespan)
+        digest = self._digest(self.keys[self.signing_key_id], url, variables, expires)
+        variables['_signature'] = "%s.%d.%s" % (self.signing_key_id, expires, digest)
+
+    def check(self, url, variables, signature):
+        """Returns whether signature is a valid and current signature of url
+        and its variables."""
+        try:
+            kid, expires, digest = signature.split('.')
+            expires = int(expires)
+        except ValueError:
+            return False
+        key = self.keys.get(kid)
+        if key is None or expires < time.time():
+            return False
+        return hmac.compare_digest(digest, self._digest(key, url, variables, expires))
+
+    def verify(self):
+        """Returns a fixture that verifies the URL."""
+        return StatelessURLVerifier(self)
@@ -0,0 +1,302 @@
+"""
+This file implements the snapshots of the storefront catalog.
+
+The catalog cache (see catalog_cache.py) is keyed by the catalog version,
+which every payment bumps, as it changes the stock: during a sale, the
+pages are computed again, from pydal rows to JSON, over and over.  A
+snapshot instead holds the JSON of the pages of the catalog without search,
+of the default size, in all the sort orders, for a content version, which
+only the changes other than of the stock bump:
+
+- when a request finds no snapshot of the current content version, a
+  background thread of its process builds it, in the file
+  catalog.<content version>.snap of the snapshots folder, while the pages
+  are computed as before; a lock file keeps the other processes from
+  building it too;
+- the processes map the file in memory, so that it is shared by all of them
+  through the page cache, and serve a page by copying its bytes;
+- the stock is overlaid: each process keeps the quantities of the products
+  changed since the snapshot was built (those with a greater revision),
+  reading them again when the catalog version changes, and patches them
+  into the pages, at the offsets recorded in the snapshot.
+
+A file holds the pages, one after the other, then their slots, which give
+the product id, the position of the stock fields in the page, and the
+quantity, of each product, then the index of the pages as JSON, and last
+the offset and length of the index.  To build the snapshot of the current
+content version from the command line:
+
+    py4web call apps vue_shop.snapshot.build
+"""
+
+import collections
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from py4web import URL
+
+from .common import db
+from .catalog import SORT_FIELDS, product_page, page_limit
+from .catalog_cache import catalog_version, content_version
+from . import settings
+
+logger = logging.getLogger("py4web:" + settings.APP_NAME)
+
+FOLDER = os.path.join(settings.DB_FOLDER, 'snapshots')
+
+# Product id, start and end of its stock fields in the page, quantity.
+SLOT = struct.Struct('<qIIq')
+# Offset and length of the index.
+TRAILER = struct.Struct('<QQ')
+
+REGEX_SNAPSHOT = re.compile(r"^catalog\.(\d+)\.snap$")
+
+# Seconds after which the lock file of a build is considered abandoned.
+LOCK_SECONDS = 600
+# Snapshots kept mapped by each process: with read replicas, requests may
+# see the previous content version for a while.
+MAX_LOADED = 2
+
+_lock = threading.Lock()
+_loaded = collections.OrderedDict()  # Content version -> Snapshot.
+_build = dict(running=False, started=0)
+stats = collections.Counter()
+
+
+def _count(outcome):
+    with _lock:
+        stats[outcome] += 1
+
+
+def snapshot_path(content):
+    return os.path.join(FOLDER, 'catalog.%d.snap' % content)
+
+
+def stock_json(quantity):
+    """Returns the stock fields that end the JSON of a product."""
+    return b'"quantity":%d,"desired_quantity":%d,"cart_quantity":0}' % (
+        quantity, min(1, quantity))
+
+
+def _image_url(key, base, thumbnail=False):
+    # As images.image_url(), which needs a request.
+    if not key:
+        return None
+    if key.startswith("data:"):
+        return None if thumbnail else key
+    return '%s/%s' % (base, key)
+
+
+def render_page(products, next_cursor, image_base, thumbnail_base):
+    """Returns the JSON of a catalog page, as catalog_page() in
+    controllers.py returns it, and the slots of its products."""
+    parts, slots = [b'{"products":['], []
+    size = len(parts[0])
+    for i, p in enumerate(products):
+        p = dict(p)
+        quantity = p.pop('quantity') or 0
+        key = p.pop('image')
+        p['image'] = _image_url(key, image_base)
+        p['thumbnail'] = _image_url(key, thumbnail_base, thumbnail=True)
+        head = json.dumps(p, separators=(',', ':'), default=str)[:-1] + ','
+        head = ((',' if i else '') + head).encode('utf8')
+        tail = stock_json(quantity)
+        slots.append((p['id'], size + len(head), size + len(head) + len(tail), quantity))
+        parts += [head, tail]
+        size += len(head) + len(tail)
+    parts.append(b'],"next_cursor":' + json.dumps(next_cursor).encode('utf8') + b'}')
+    return b''.join(parts), slots
+
+
+def page_key(sort, cursor):
+    return '%s:%s' % (sort, cursor or '')
+
+
+def _write(path, image_base, thumbnail_base):
+    """Writes the snapshot of the products to path.  Returns the catalog
+    version and content version it was taken at."""
+    row = db.catalog_state(1)
+    revision, content = row.version, row.content_version or 0
+    pages, slots, offset = {}, bytearray(), 0
+    with open(path, 'wb') as f:
+        for sort in SORT_FIELDS:
+            cursor = None
+            while True:
+                products, next_cursor = product_page(db.product.id > 0, sort=sort, cursor=cursor)
+                body, page_slots = render_page(products, next_cursor, image_base, thumbnail_base)
+                pages[page_key(sort, cursor)] = [offset, len(body),
+                                                 len(slots) // SLOT.size, len(page_slots)]
+                f.write(body)
+                offset += len(body)
+                for s in page_slots:
+                    slots += SLOT.pack(*s)
+                if next_cursor is None:
+                    break
+                cursor = next_cursor
+        f.write(slots)
+        index = json.dumps(dict(revision=revision, content_version=content,
+                                slots=offset, pages=pages)).encode('utf8')
+        f.write(index)
+        f.write(TRAILER.pack(offset + len(slots), len(index)))
+    return revision, content
+
+
+def build(image_base=None, thumbnail_base=None):
+    """Builds the snapshot of the current content version, unless it exists
+    or another process is building it.  Returns its path, or None if it
+    was not built."""
+    image_base = image_base or '/%s/image' % settings.APP_NAME
+    thumbnail_base = thumbnail_base or '/%s/thumbnail' % settings.APP_NAME
+    os.makedirs(FOLDER, exist_ok=True)
+    content = (db.catalog_state(1).content_version or 0)
+    path = snapshot_path(content)
+    if os.path.exists(path):
+        return path
+    lock = path + '.lock'
+    try:
+        if time.time() - os.path.getmtime(lock) > LOCK_SECONDS:
+            os.unlink(lock)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        t0 = time.time()
+        revision, started = _write(tmp, image_base, thumbnail_base)
+        # The pages are read by several queries: if the content changed in
+        # the meantime, they may be inconsistent.  Changes of the stock are
+        # overlaid anyway.
+        if started != content or (db.catalog_state(1).content_version or 0) != content:
+            return None
+        os.replace(tmp, path)
+        _count('builds')
+        logger.info("Built the catalog snapshot %s in %.2fs", path, time.time() - t0)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        os.unlink(lock)
+    # Removes the older snapshots, keeping the previous one for the
+    # processes still at it.
+    versions = sorted(int(m.group(1)) for m in map(REGEX_SNAPSHOT.match, os.listdir(FOLDER)) if m)
+    for v in versions[:-2]:
+        os.unlink(snapshot_path(v))
+    return path
+
+
+def _build_in_background(image_base, thumbnail_base):
+    # This runs in its own thread, so it needs its own db connection.
+    db._adapter.reconnect()
+    try:
+        build(image_base, thumbnail_base)
+    except Exception as e:
+        logger.error("Could not build the catalog snapshot: %s", e)
+    finally:
+        db._adapter.close()
+        with _lock:
+            _build['running'] = False
+
+
+def _start_build():
+    """Starts building the snapshot, at most once a second; the image URLs
+    are computed here, as the thread has no request."""
+    now = time.time()
+    with _lock:
+        if _build['running'] or now - _build['started'] < 1:
+            return
+        _build.update(running=True, started=now)
+    threading.Thread(target=_build_in_background, args=(URL('image'), URL('thumbnail')),
+                     daemon=True).start()
+
+
+class Snapshot:
+    """A snapshot file, mapped in memory, with the stock changed since."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+        index = json.loads(self.data[offset:offset + length])
+        self.revision = index['revision']
+        self.content_version = index['content_version']
+        self.slots = index['slots']
+        self.pages = index['pages']
+        self.lock = threading.Lock()
+        self.stock = {}  # Product id -> quantity, of the products changed since.
+        self.seen = self.revision  # Catalog version up to which stock is current.
+
+    def update_stock(self):
+        """Reads the quantities of the products changed since the last
+        catalog version seen."""
+        version = catalog_version()
+        if version <= self.seen:
+            return
+        seen = self.seen
+        rows = db(db.product.revision > seen).select(db.product.id, db.product.quantity)
+        with self.lock:
+            self.stock.update((r.id, r.quantity or 0) for r in rows)
+            self.seen = max(self.seen, version)
+
+    def page(self, key):
+        """Returns the JSON of a page, with the current stock, or None."""
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+        offset, length, first, n = entry
+        body = self.data[offset:offset + length]
+        start = self.slots + first * SLOT.size
+        patches = [(begin, end, self.stock[product_id])
+                   for product_id, begin, end, quantity
+                   in SLOT.iter_unpack(self.data[start:start + n * SLOT.size])
+                   if self.stock.get(product_id, quantity) != quantity]
+        if not patches:
+            return body
+        parts, last = [], 0
+        for begin, end, quantity in patches:
+            parts += [body[last:begin], stock_json(quantity)]
+            last = end
+        parts.append(body[last:])
+        return b''.join(parts)
+
+
+def _snapshot(content):
+    """Returns the snapshot of a content version, loading it if needed; if
+    there is none, starts building it, and returns None."""
+    with _lock:
+        snapshot = _loaded.get(content)
+    if snapshot is not None:
+        return snapshot
+    path = snapshot_path(content)
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        _start_build()
+        return None
+    with _lock:
+        snapshot = _loaded.setdefault(content, snapshot)
+        while len(_loaded) > MAX_LOADED:
+            # The mapping is closed when the requests using it are done.
+            _loaded.popitem(last=False)
+    return snapshot
+
+
+def catalog_page(q='', sort='id', cursor=None, limit=None):
+    """Returns, for the parameters of get_products, the page as JSON bytes,
+    or None if it is not in a snapshot."""
+    if not settings.CATALOG_SNAPSHOTS or q or page_limit(limit) != settings.CATALOG_PAGE_SIZE:
+        return None
+    snapshot = _snapshot(content_version())
+    body = None
+    if snapshot is not None:
+        snapshot.update_stock()
+        body = snapshot.page(page_key(sort if sort in SORT_FIELDS else 'id', cursor))
+    _count('hits' if body is not None else 'misses')
+    return body
@@ -0,0 +1,147 @@
+"""
+This file implements the timing of the startup of the app, and the
+skipping of the migration checks when the schema has not changed.
+
+Workers are restarted, and new instances started, often: the import of the
+app should be quick.  Its phases (the connection to the database, the auth
+tables, the models, the controllers, ...) are timed with phase(), and the
+times are logged, at the info level, once the app is loaded:
+
+    Started in 0.210s: db 0.004s, auth 0.011s, models 0.012s, ...
+
+They are also served by the metrics action, and printed by:
+
+    py4web call apps vue_shop.startup.report
+
+With DB_SKIP_UNCHANGED_MIGRATIONS, the tables are migrated only when the
+schema hash changes.  The hash covers the files that define the tables and
+their settings (common.py, models.py, the settings), the versions of py4web
+and pydal, and the database URI; it is recorded in DB_FOLDER after the
+migrations.  If the tables are changed by hand, delete DB_FOLDER/schema.hash
+to have them checked again.
+
+check() imports the app in a new process, as a starting worker does, and
+fails if that takes longer than STARTUP_BUDGET_SECONDS, e.g. in CI:
+
+    py4web call apps vue_shop.startup.check
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import py4web
+import pydal
+
+from . import settings
+
+logger = logging.getLogger("py4web:" + settings.APP_NAME)
+
+started = time.perf_counter()
+timings = collections.OrderedDict()  # Phase -> seconds.
+
+SCHEMA_FILE = os.path.join(settings.DB_FOLDER, 'schema.hash')
+SCHEMA_SOURCES = ['common.py', 'models.py', 'search.py', 'settings.py', 'settings_private.py']
+
+_schema_hash = None
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the block as a phase of the startup."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - t0
+
+
+def finish():
+    """Records the end of the startup, and logs the times of its phases;
+    the time outside of them, mostly imports, is reported as other."""
+    total = time.perf_counter() - started
+    timings['other'] = total - sum(v for k, v in timings.items() if k != 'other')
+    timings['total'] = total
+    logger.info("Started in %.3fs: %s", total, ', '.join(
+        '%s %.3fs' % kv for kv in timings.items() if kv[0] != 'total'))
+
+
+def report():
+    """Prints and returns the times of the phases of the startup of this
+    process."""
+    result = {k: round(v, 4) for k, v in timings.items()}
+    print(json.dumps(result, indent=2))
+    return result
+
+
+def schema_hash():
+    global _schema_hash
+    if _schema_hash is None:
+        h = hashlib.sha256()
+        for part in [settings.DB_URI, settings.SESSION_TYPE, py4web.__version__, pydal.__version__]:
+            h.update(str(part).encode('utf8') + b'\0')
+        for name in SCHEMA_SOURCES:
+            path = os.path.join(settings.APP_FOLDER, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+        _schema_hash = h.hexdigest()
+    return _schema_hash
+
+
+def schema_changed():
+    """Tells if the schema may have changed since the last migration."""
+    try:
+        with open(SCHEMA_FILE) as f:
+            return f.read().strip() != schema_hash()
+    except FileNotFoundError:
+        return True
+
+
+def record_schema():
+    """Records the schema hash, once the tables are migrated."""
+    tmp = '%s.%d.tmp' % (SCHEMA_FILE, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(schema_hash() + '\n')
+    os.replace(tmp, SCHEMA_FILE)
+
+
+# The child process of check(): imports the app, and prints its timings.
+CHILD = """
+import importlib, json, sys, time
+t0 = time.perf_counter()
+import py4web
+sys.path.insert(0, %(root)r)
+importlib.import_module(%(module)r)
+startup = sys.modules[%(module)r + '.startup']
+print(json.dumps(dict(startup.timings, py4web=startup.started - t0,
+                      total=time.perf_counter() - t0)))
+"""
+
+
+def check(budget=None, runs=3):
+    """Imports the app in new processes, runs times, and prints the times of
+    the fastest; exits with an error if it took more than budget seconds
+    (by default STARTUP_BUDGET_SECONDS), py4web itself included."""
+    budget = budget or settings.STARTUP_BUDGET_SECONDS
+    apps_folder = os.path.dirname(os.path.abspath(settings.APP_FOLDER))
+    code = CHILD % dict(root=os.path.dirname(apps_folder),
+                        module='%s.%s' % (os.path.basename(apps_folder), settings.APP_NAME))
+    env = dict(os.environ, PY4WEB_APPS_FOLDER=apps_folder)
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                             text=True, check=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    best = min(results, key=lambda r: r['total'])
+    result = dict(budget=budget, **{k: round(v, 4) for k, v in best.items()})
+    print(json.dumps(result, indent=2))
+    if best['total'] > budget:
+        sys.exit("The app took %.3fs to start, over the budget of %.3fs" % (best['total'], budget))
+    return result
@@ -9,6 +9,8 @@ let init = (app) => {
     // This is the Vue data.
     app.data = {
         products: [], // Products
+        next_cursor: null, // Cursor of the next page of products, if any.
+        loading: false, // A page of products is being loaded.
         cart: [], // Cart
         product_search: '',
         cart_size: 0,
@@ -16,6 +18,7 @@ let init = (app) => {
         page: 'prod', // Page : cart or prod.
         checkout_state: 'checkout', // checkout, then pay.
         fulfillment: {name: "", address: ""}, // This is just an example
+        queue_position: null, // Position in the waiting room of the payments.
     };
 
     app.stripe_session_id = null;
@@ -35,13 +38,57 @@ let init = (app) => {
     };
 
     app.get_products = function () {
-        // Gets products in response to page load or query.
-        axios.get(products_url, {params: {q: app.vue.product_search}})
+        // Gets the first page of products in response to page load or query.
+        let q = app.vue.product_search;
+        app.vue.loading = true;
+        axios.get(products_url, {params: {q: q}})
             .then(function (r) {
+                if (q !== app.vue.product_search) {
+                    return; // A newer search is under way.
+                }
                 app.vue.products = app.annotate(r.data.products);
+                app.vue.next_cursor = r.data.next_cursor;
+                app.vue.loading = false;
+            })
+            .catch(function () {
+                if (q === app.vue.product_search) {
+                    app.vue.loading = false; // So that scrolling tries again.
+                }
             });
     };
 
+    app.load_more = function () {
+        // Appends the next page of products, if there is one.
+        if (app.vue.loading || !app.vue.next_cursor) {
+            return;
+        }
+        let q = app.vue.product_search;
+        app.vue.loading = true;
+        axios.get(products_url, {params: {q: q, cursor: app.vue.next_cursor}})
+            .then(function (r) {
+                if (q !== app.vue.product_search) {
+                    return;
+                }
+                app.vue.products = app.annotate(
+                    app.vue.products.concat(r.data.products));
+                app.vue.next_cursor = r.data.next_cursor;
+                app.vue.loading = false;
+            })
+            .catch(function () {
+                if (q === app.vue.product_search) {
+                    app.vue.loading = false; // So that scrolling tries again.
+                }
+            });
+    };
+
+    app.on_scroll = function () {
+        // Loads more products when the user gets near the end of the page.
+        if (app.vue.page === 'prod' &&
+            window.innerHeight + window.scrollY >= document.body.offsetHeight - 800) {
+            app.load_more();
+        }
+    };
+
     app.clear_search = function () {
         app.vue.product_search = "";
         app.get_products();
@@ -166,23 +213,64 @@ let init = (app) => {
             });
     };
 
-    app.pay = function () {
+    app.redirect_to_stripe = function (stripe_session_id) {
+        if (fake_checkout_url) {
+            // The server uses the fake payment gateway.
+            window.location = fake_checkout_url + "?session_id=" + encodeURIComponent(stripe_session_id);
+            return;
+        }
+        stripe = Stripe(stripe_key);
+        stripe.redirectToCheckout({
+            sessionId: stripe_session_id,
+        }).then(function (result) {
+            Q.flash(result.error.message);
+        });
+    };
+
+    app.wait_for_session = function (status_url) {
+        // The server creates the Stripe session in the background; we poll
+        // until it is ready.
+        axios.get(status_url).then(function (r) {
+            if (r.data.status === 'ready') {
+                app.redirect_to_stripe(r.data.session_id);
+            } else if (r.data.status === 'failed') {
+                Q.flash("Sorry, we could not start the payment; please try again.");
+            } else {
+                setTimeout(function () { app.wait_for_session(status_url); }, 500);
+            }
+        });
+    };
+
+    app.pay = function (ticket) {
         // When one clicks pay, this contacts the server, to store the fulfillment
         // information and get a Stripe session id, and then redirects to Stripe.
         axios.post(pay_url, {
             items: app.items,
-            fulfillment: app.vue.fulfillment
+            fulfillment: app.vue.fulfillment,
+            ticket: ticket,
         }).then(function (r) {
+            if (r.data.ticket) {
+                // Too many customers are paying: we wait for our turn, and
+                // ask again with our ticket.
+                // The position is not known when the poll reached another
+                // server process than that of the ticket.
+                app.vue.queue_position = r.data.position || app.vue.queue_position;
+                setTimeout(function () { app.pay(r.data.ticket); }, 1000 * r.data.retry_after);
+                return;
+            }
+            app.vue.queue_position = null;
             if (r.data.ok) {
                 // The server says: ok, the transaction can be performed.
-                let stripe_session_id = r.data.session_id;
                 app.vue.checkout_state = "pay";
-                stripe = Stripe(stripe_key);
-                stripe.redirectToCheckout({
-                    sessionId: stripe_session_id,
-                }).then(function (result) {
-                    Q.flash(result.error.message);
-                });
+                if (r.data.session_id) {
+                    app.redirect_to_stripe(r.data.session_id);
+                } else {
+                    app.wait_for_session(r.data.status_url);
+                }
+            } else if (r.data.error === "busy") {
+                Q.flash("Sorry, we have too many customers right now; please try again in a moment.");
+            } else if (r.data.error) {
+                Q.flash("Sorry, we could not start the payment; please try again.");
             } else {
                 // The server says: nope.  See above.
                 app.vue.get_products();
@@ -194,10 +282,10 @@ let init = (app) => {
         });
     };
 
-
     // This contains all the methods.
     app.methods = {
         get_products: app.get_products,
+        load_more: app.load_more,
         inc_desired_quantity: app.inc_desired_quantity,
         inc_cart_quantity: app.inc_cart_quantity,
         goto: app.goto,
@@ -220,6 +308,7 @@ let init = (app) => {
     app.init = () => {
         // Load the products...
         app.vue.get_products();
+        window.addEventListener('scroll', app.on_scroll);
         // .. and the cart.
         if (clear_cart) {
             console.log("clearing the cart");
@@ -21,6 +21,10 @@ let init = (app) => {
         rows: [],
     };
 
+    // Revision of the products we have; the server sends us only what
+    // changed after it.
+    app.revision = null;
+
     app.enumerate = (a) => {
         // This adds an _idx field to each element of the array.
         let k = 0;
@@ -53,6 +57,7 @@ let init = (app) => {
             app.vue.rows.push();
             msg.id = response.data.id;
             msg.image = null; // For reactivity on it.
+            msg.thumbnail = null;
             msg._state = {};
             for (let f of app.vue.fields) {
                 msg._state[f[1]] = "clean";
@@ -96,18 +101,50 @@ let init = (app) => {
         let row = app.vue.rows[row_idx];
         if (row._state[fn] === "edit") {
             row._state[fn] = "pending";
-            axios.post(edit_url,
-                {
-                    id: row.id,
-                    field: fn,
-                    value: row[fn], // row.first_name
-                }).then(function (result) {
-                row._state[fn] = "clean";
-            });
+            // Edits are sent in batches; quick successive edits of several
+            // cells result in a single request.
+            app.pending_edits.push({row: row, field: fn});
+            if (app.edits_timer === null) {
+                app.edits_timer = setTimeout(app.send_edits, 300);
+            }
         }
         // If I was not editing, there is nothing that needs saving.
     }
 
+    app.pending_edits = [];
+    app.edits_timer = null;
+
+    app.send_edits = function () {
+        let edits = app.pending_edits;
+        app.pending_edits = [];
+        app.edits_timer = null;
+        axios.post(edits_url, {
+            changes: edits.map((e) => ({
+                id: e.row.id,
+                field: e.field,
+                value: e.row[e.field],
+            })),
+        }).then(function (result) {
+            for (let e of edits) {
+                e.row._state[e.field] = "clean";
+            }
+        });
+    };
+
+    app.import_file = function (event) {
+        // Imports a CSV or JSONL file of products.
+        let file = event.target.files[0];
+        if (file) {
+            let format = file.name.endsWith('.jsonl') ? 'jsonl' : 'csv';
+            axios.post(import_url, file, {
+                params: {format: format},
+                headers: {'Content-Type': format === 'csv' ? 'text/csv' : 'application/x-ndjson'},
+            }).then(function () {
+                app.sync();
+            });
+        }
+    };
+
     app.upload_file = function (event, row_idx) {
         let input = event.target;
         let file = input.files[0];
@@ -122,9 +159,10 @@ let init = (app) => {
                         product_id: row.id,
                         image: image,
                     })
-                    .then(function () {
-                        // Sets the local preview.
-                        row.image = image;
+                    .then(function (response) {
+                        // The server returns the URLs of the stored image.
+                        row.image = response.data.image;
+                        row.thumbnail = response.data.thumbnail;
                     });
             });
             reader.readAsDataURL(file);
@@ -140,6 +178,7 @@ let init = (app) => {
         start_edit: app.start_edit,
         stop_edit: app.stop_edit,
         upload_file: app.upload_file,
+        import_file: app.import_file,
     };
 
     // This creates the Vue instance.
@@ -159,11 +198,39 @@ let init = (app) => {
         }
         axios.get(load_url).then(function (response) {
             app.vue.rows = app.decorate(app.enumerate(response.data.rows));
-            if (response.data.clear_cart) {
-                selv.vue.cart = [];
-                self.update_cart();
-                self.store_cart();
+            app.revision = response.data.revision;
+        });
+        // Keeps the list up to date with the changes made elsewhere.
+        setInterval(app.sync, 30000);
+        window.addEventListener('focus', app.sync);
+    };
+
+    app.sync = function () {
+        // Gets the products changed since our revision, and patches the list.
+        if (app.revision === null) {
+            return;
+        }
+        axios.get(load_url, {params: {since: app.revision}}).then(function (response) {
+            let by_id = {};
+            for (let r of app.vue.rows) {
+                by_id[r.id] = r;
+            }
+            for (let r of app.decorate(response.data.rows)) {
+                let row = by_id[r.id];
+                if (row === undefined) {
+                    app.vue.rows.push(r);
+                } else {
+                    // Fields being edited are left alone.
+                    for (let k in r) {
+                        if (k !== '_state' && row._state[k] !== 'edit' && row._state[k] !== 'pending') {
+                            row[k] = r[k];
+                        }
+                    }
+                }
             }
+            let deleted = new Set(response.data.deleted);
+            app.vue.rows = app.enumerate(app.vue.rows.filter((r) => !deleted.has(r.id)));
+            app.revision = response.data.revision;
         });
     };
 
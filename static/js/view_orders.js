@@ -0,0 +1,124 @@
+// This will be the object that will contain the Vue attributes
+// and be used to initialize it.
+let app = {};
+
+
+// Given an empty app object, initializes it filling its attributes,
+// creates a Vue instance, and then initializes the Vue instance.
+let init = (app) => {
+
+    // This is the Vue data.
+    app.data = {
+        filter: {paid: "", start: "", end: ""},
+        orders: [],
+        next_cursor: null,
+        count: 0,
+        daily_sales: [],
+        loading: false,
+    };
+
+    // Each request gets a number, so that responses to an older filter,
+    // arriving late, are ignored.
+    app.request_number = 0;
+
+    app.decorate = (a) => {
+        // The details of an order are loaded only when it is expanded.
+        for (let o of a) {
+            o._expanded = false;
+            o._details = null;
+        }
+        return a;
+    };
+
+    app.params = function (cursor) {
+        let params = {};
+        for (let k in app.vue.filter) {
+            if (app.vue.filter[k]) {
+                params[k] = app.vue.filter[k];
+            }
+        }
+        if (cursor) {
+            params.cursor = cursor;
+        }
+        return params;
+    };
+
+    app.load = function () {
+        let n = ++app.request_number;
+        app.vue.loading = true;
+        axios.get(load_orders_url, {params: app.params()}).then(function (response) {
+            if (n !== app.request_number) {
+                return;
+            }
+            app.vue.orders = app.decorate(response.data.orders);
+            app.vue.next_cursor = response.data.next_cursor;
+            app.vue.count = response.data.count;
+            app.vue.daily_sales = response.data.daily_sales;
+            app.vue.loading = false;
+        });
+    };
+
+    app.load_more = function () {
+        if (app.vue.loading || !app.vue.next_cursor) {
+            return;
+        }
+        let n = app.request_number;
+        app.vue.loading = true;
+        axios.get(load_orders_url, {params: app.params(app.vue.next_cursor)}).then(function (response) {
+            if (n !== app.request_number) {
+                return;
+            }
+            app.vue.orders = app.vue.orders.concat(app.decorate(response.data.orders));
+            app.vue.next_cursor = response.data.next_cursor;
+            app.vue.loading = false;
+        });
+    };
+
+    app.toggle = function (order) {
+        order._expanded = !order._expanded;
+        if (order._expanded && order._details === null) {
+            axios.get(order_details_url, {params: {id: order.id}}).then(function (response) {
+                order._details = response.data;
+            });
+        }
+    };
+
+    // We form the dictionary of all methods, so we can assign them
+    // to the Vue app in a single blow.
+    app.methods = {
+        load: app.load,
+        load_more: app.load_more,
+        toggle: app.toggle,
+    };
+
+    app.computed = {
+        sales_total: function () {
+            let total = {orders: 0, revenue: 0};
+            for (let d of this.daily_sales) {
+                total.orders += d.orders;
+                total.revenue += d.revenue;
+            }
+            return total;
+        },
+    };
+
+    // This creates the Vue instance.
+    app.vue = new Vue({
+        el: "#vue-target",
+        data: app.data,
+        methods: app.methods,
+        computed: app.computed,
+    });
+
+    // And this initializes it.
+    app.init = () => {
+        app.load();
+    };
+
+    // Call to the initializer.
+    app.init();
+};
+
+// This takes the (empty) app object, and initializes it,
+// putting all the code i
+init(app);
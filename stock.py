@@ -0,0 +1,230 @@
+"""
+This file implements the reservation of stock for orders.
+
+When a customer pays, the quantities of the products in the cart are taken
+out of the stock and recorded as reservations of the order.  Each product is
+decremented with a conditional update:
+
+    UPDATE product SET quantity = quantity - n WHERE id = ? AND quantity >= n
+
+so two concurrent checkouts can never both take the last items: the second
+update matches no row.  If any product of the cart cannot be reserved, the
+whole transaction is rolled back, so a cart is reserved all or nothing.
+
+The catalog version, whose row stays locked until the transaction commits,
+is bumped last, once the products are updated: the checkouts of different
+products then do not wait for each other, but only, briefly, for the end of
+their transactions.  Every change of the stock locks the products first,
+and the version last, so that two of them cannot deadlock.
+
+A reservation is "held" until the order is paid ("committed"), or until the
+payment is cancelled or the reservation expires ("released"), in which case
+the quantity goes back into the stock.
+"""
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+import uuid
+
+from .common import db
+from .models import get_time
+from .settings import RESERVATION_MINUTES
+from .catalog_cache import stamp_products
+from .admission import stock_counter
+
+HELD, COMMITTED, RELEASED = 'held', 'committed', 'released'
+
+
+def cart_quantities(items):
+    """Returns a dictionary from product id to total quantity in the cart."""
+    wanted = {}
+    for it in items:
+        product_id = int(it['product_id'])
+        wanted[product_id] = wanted.get(product_id, 0) + int(it['quantity'])
+    return wanted
+
+
+def reserve(order_id, items):
+    """Takes the items out of the stock, and records them as reserved for the
+    order.  Returns True if the whole cart could be reserved; otherwise, rolls
+    back the transaction and returns False."""
+    wanted = cart_quantities(items)
+    # Products are always locked in the same order, to avoid deadlocks.
+    for product_id in sorted(wanted):
+        n = wanted[product_id]
+        updated = db((db.product.id == product_id) & (db.product.quantity >= n)).update(
+            quantity=db.product.quantity - n)
+        if not updated:
+            db.rollback()
+            return False
+    expires_on = get_time() + datetime.timedelta(minutes=RESERVATION_MINUTES)
+    db.stock_reservation.bulk_insert([
+        dict(order_id=order_id, product_id=product_id, quantity=n, expires_on=expires_on)
+        for product_id, n in wanted.items()
+    ])
+    set_revision(wanted)
+    return True
+
+
+def set_revision(product_ids):
+    """Bumps the catalog version, and makes it the revision of the products,
+    whose stock has changed.  Call it last, after updating the products."""
+    stamp_products(product_ids, stock_only=True)
+
+
+def release(order_id):
+    """Returns to the stock the quantities held for the order."""
+    rows = db((db.stock_reservation.order_id == order_id) &
+              (db.stock_reservation.status == HELD)).select(
+        orderby=db.stock_reservation.product_id)
+    released = []
+    for r in rows:
+        # The conditional update guarantees that, if two requests release the
+        # same order at once, only one of them gives back the quantity.
+        if db((db.stock_reservation.id == r.id) &
+              (db.stock_reservation.status == HELD)).update(status=RELEASED):
+            db(db.product.id == r.product_id).update(quantity=db.product.quantity + r.quantity)
+            released.append(r.product_id)
+    if released:
+        set_revision(released)
+        stock_counter.forget(released)
+
+
+def restore_quantities(quantities):
+    """Adds back to the stock a dictionary from product id to quantity, with
+    one update per product."""
+    if not quantities:
+        return
+    for product_id, n in sorted(quantities.items()):
+        db(db.product.id == product_id).update(quantity=db.product.quantity + n)
+    set_revision(quantities)
+    stock_counter.forget(quantities)
+
+
+def release_orders(order_ids):
+    """Returns to the stock the quantities held for many orders at once."""
+    # The held reservations are first claimed with a single update, so that
+    # a concurrent release of the same orders cannot give them back twice.
+    claim = 'releasing-%s' % uuid.uuid4().hex
+    if not db((db.stock_reservation.order_id.belongs(order_ids)) &
+              (db.stock_reservation.status == HELD)).update(status=claim):
+        return
+    total = db.stock_reservation.quantity.sum()
+    rows = db(db.stock_reservation.status == claim).select(
+        db.stock_reservation.product_id, total, groupby=db.stock_reservation.product_id)
+    restore_quantities({r.stock_reservation.product_id: r[total] for r in rows})
+    db(db.stock_reservation.status == claim).update(status=RELEASED)
+
+
+def commit(order_ids):
+    """Marks the quantities held for the orders as sold."""
+    db((db.stock_reservation.order_id.belongs(order_ids)) &
+       (db.stock_reservation.status == HELD)).update(status=COMMITTED)
+
+
+def audit(path, save=False):
+    """Checks that no stock was oversold, e.g. after a load test.  With save,
+    writes the quantities of the products to the file path; otherwise,
+    checks against them that no quantity is negative, and that each
+    quantity plus the quantities reserved since (held or sold) is still the
+    quantity saved.  Prints, and returns, the result.  From the command line:
+
+        py4web call apps vue_shop.stock.audit --args '{"path": "/tmp/stock.json", "save": true}'
+    """
+    quantities = {str(r.id): r.quantity or 0
+                  for r in db(db.product).select(db.product.id, db.product.quantity)}
+    last = db.stock_reservation.id.max()
+    last = db(db.stock_reservation).select(last).first()[last] or 0
+    if save:
+        with open(path, 'w') as f:
+            json.dump(dict(quantities=quantities, last_reservation=last), f)
+        result = dict(products=len(quantities))
+    else:
+        with open(path) as f:
+            saved = json.load(f)
+        total = db.stock_reservation.quantity.sum()
+        since = db.stock_reservation.id > saved['last_reservation']
+        reserved, sold = {}, 0
+        for r in db(since & (db.stock_reservation.status != RELEASED)).select(
+                db.stock_reservation.product_id, db.stock_reservation.status, total,
+                groupby=(db.stock_reservation.product_id, db.stock_reservation.status)):
+            product_id = str(r.stock_reservation.product_id)
+            reserved[product_id] = reserved.get(product_id, 0) + r[total]
+            if r.stock_reservation.status == COMMITTED:
+                sold += r[total]
+        negative = sorted(int(k) for k, v in quantities.items() if v < 0)
+        mismatched = sorted(int(k) for k, v in saved['quantities'].items()
+                            if k in quantities and quantities[k] + reserved.get(k, 0) != v)
+        result = dict(products=len(quantities), reserved=sum(reserved.values()), sold=sold,
+                      negative=negative[:20], mismatched=mismatched[:20],
+                      ok=not negative and not mismatched)
+    print(json.dumps(result))
+    return result
+
+
+def stress(threads=20, units=5):
+    """Checks that concurrent checkouts cannot oversell: threads customers,
+    each with its own connection and transaction, try at once to reserve
+    one of the last units of a product.  Exactly units of them must succeed,
+    the quantity must never be seen below 0, and end at 0, and audit() must
+    pass.  Prints, and returns, the result, and raises AssertionError if it
+    is not ok.  It adds a product and orders: run it on a scratch database,
+    e.g. an SQLite file in a temporary folder (see the end of settings.py):
+
+        SHOP_BENCHMARK_FOLDER=$(mktemp -d) py4web call apps vue_shop.stock.stress
+    """
+    product_id = db.product.insert(product_name='Stress test', quantity=units, price=1)
+    db.commit()
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    audit(path, save=True)
+    items = [dict(product_id=product_id, quantity=1)]
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    orders, sold, seen, errors = [], [], [], []
+
+    def customer():
+        # Each thread needs its own db connection.
+        db._adapter.reconnect()
+        try:
+            order_id = db.customer_order.insert(ordered_items=json.dumps(items))
+            db.commit()
+            with lock:
+                orders.append(order_id)
+            barrier.wait()
+            if reserve(order_id, items):
+                db.commit()
+                with lock:
+                    sold.append(order_id)
+            quantity = db.product(product_id).quantity
+            with lock:
+                seen.append(quantity)
+        except Exception as e:
+            db.rollback()
+            with lock:
+                errors.append(str(e))
+        finally:
+            db._adapter.close()
+
+    workers = [threading.Thread(target=customer) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    checked = audit(path)
+    os.unlink(path)
+    quantity = db.product(product_id).quantity
+    result = dict(threads=threads, units=units, sold=len(sold), quantity=quantity,
+                  lowest=min(seen) if seen else None, errors=errors[:5],
+                  audit=checked['ok'])
+    result['ok'] = (len(sold) == min(units, threads) and quantity == units - len(sold)
+                    and min(seen + [quantity]) >= 0 and not errors and checked['ok'])
+    db(db.customer_order.id.belongs(orders)).delete()
+    db(db.product.id == product_id).delete()
+    db.commit()
+    print(json.dumps(result))
+    assert result['ok'], "The stock was oversold: %s" % json.dumps(result)
+    return result
@@ -10,25 +10,25 @@ To use celery tasks:
 
 """
 from .common import settings, scheduler, db, Field
+from .reaper import reap_abandoned_orders
 
-# example of task that needs db access
+# reaps the abandoned orders, returning their stock (see reaper.py)
 @scheduler.task
-def my_task():
+def reap_orders():
     try:
         # this task will be executed in its own thread, connect to db
         db._adapter.reconnect()
-        # do something here
-        db.commit()
+        reap_abandoned_orders()
     except:
         # rollback on failure
         db.rollback()
 
 
-# run my_task very 10 seconds
+# run reap_orders every REAPER_INTERVAL seconds
 scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
+    "reap_orders": {
+        "task": "apps.%s.tasks.reap_orders" % settings.APP_NAME,
+        "schedule": float(settings.REAPER_INTERVAL),
         "args": (),
     },
 }
@@ -0,0 +1,259 @@
+"""
+This file processes the events sent by the Stripe webhook.
+
+Each event is verified against its Stripe-Signature header, and recorded in
+the payment_event table; as event ids are unique, an event delivered twice
+is recorded, and applied, only once.  Recorded events are applied to the
+orders in the background, after a short delay (WEBHOOK_BATCH_DELAY), so that
+a burst of events, as happens after a sale, results in a single update of
+the customer_order table that marks the orders as paid (see mark_paid()).
+
+replay() fires synthetic events through the same path, to measure the
+throughput of the pipeline; from the command line:
+
+    py4web call apps vue_shop.webhooks.replay
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+
+from .common import db, logger
+from .models import get_time
+from .orders import record_paid, rebuild_daily_sales
+from .reaper import EXPIRED, check_late_payments
+from .settings import PAYMENT_WEBHOOK_SECRET, WEBHOOK_BATCH_DELAY
+from . import stock
+
+# Maximum age, in seconds, of the timestamp of a signed event.
+SIGNATURE_TOLERANCE = 300
+
+SESSION_COMPLETED = 'checkout.session.completed'
+SESSION_EXPIRED = 'checkout.session.expired'
+
+
+# Signatures, as in https://stripe.com/docs/webhooks/signatures
+
+def sign(payload, secret, timestamp=None):
+    """Returns the Stripe-Signature header for the payload."""
+    timestamp = int(timestamp or time.time())
+    signed = ("%d." % timestamp).encode('utf8') + payload
+    sig = hmac.new(secret.encode('utf8'), signed, hashlib.sha256).hexdigest()
+    return "t=%d,v1=%s" % (timestamp, sig)
+
+
+def verify_signature(payload, header, secret, tolerance=SIGNATURE_TOLERANCE):
+    """Checks that the Stripe-Signature header is valid for the payload."""
+    if not header or not secret:
+        return False
+    timestamp, signatures = None, []
+    for item in header.split(','):
+        k, _, v = item.strip().partition('=')
+        if k == 't':
+            timestamp = v
+        elif k == 'v1':
+            signatures.append(v)
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    signed = ("%d." % timestamp).encode('utf8') + payload
+    expected = hmac.new(secret.encode('utf8'), signed, hashlib.sha256).hexdigest()
+    return any(hmac.compare_digest(expected, s) for s in signatures)
+
+
+# Recording events.
+
+def receive(payload, header, secret=None):
+    """Verifies a webhook request and returns its event.  Raises ValueError
+    if the signature or the payload are not valid."""
+    if not verify_signature(payload, header, secret or PAYMENT_WEBHOOK_SECRET):
+        raise ValueError("Invalid signature")
+    event = json.loads(payload)
+    if not isinstance(event, dict) or 'id' not in event:
+        raise ValueError("Invalid event")
+    return event
+
+
+def event_order_id(event):
+    """Returns the id of the order an event refers to, if any."""
+    obj = event.get('data', {}).get('object', {})
+    try:
+        return int(obj.get('client_reference_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def record(event):
+    """Records an event.  Returns False if the event had already been
+    received."""
+    if not db(db.payment_event.event_id == event['id']).isempty():
+        return False
+    try:
+        db.payment_event.insert(
+            event_id=event['id'],
+            event_type=event.get('type'),
+            order_id=event_order_id(event),
+        )
+    except Exception:
+        # Another request recorded the same event at the same time.
+        db.rollback()
+        return False
+    return True
+
+
+# Applying events.
+
+def mark_paid(order_ids, now):
+    """Marks as paid, with a single update, the orders that are not paid yet,
+    and returns their ids.  Other applies, of this process or of others, may
+    pay some of the same orders at the same time: the update appends a claim
+    to the payment_status of the orders it changes, so that each order is
+    counted in the sales only by the apply that paid it.  The claim is then
+    removed, with an update per payment_status."""
+    claim = ':paying-%s' % uuid.uuid4().hex
+    status = db.customer_order.payment_status
+    db(db.customer_order.id.belongs(order_ids) & (db.customer_order.paid == False)).update(
+        paid=True, paid_on=now, payment_status=status.coalesce('') + claim)
+    claimed = db(db.customer_order.id.belongs(order_ids) & status.endswith(claim)).select(
+        db.customer_order.id, status)
+    by_status = {}
+    for order in claimed:
+        by_status.setdefault(order.payment_status[:-len(claim)], []).append(order.id)
+    for previous, ids in by_status.items():
+        db(db.customer_order.id.belongs(ids)).update(payment_status=previous or None)
+    return sorted(order.id for order in claimed)
+
+
+def apply_pending_events(batch_size=1000):
+    """Applies to the orders a batch of recorded events, and commits.
+    Returns the number of events applied."""
+    events = db(db.payment_event.processed == False).select(
+        orderby=db.payment_event.id, limitby=(0, batch_size))
+    if not events:
+        return 0
+    paid = {e.order_id for e in events if e.event_type == SESSION_COMPLETED and e.order_id}
+    expired = {e.order_id for e in events if e.event_type == SESSION_EXPIRED and e.order_id}
+    if paid:
+        now = get_time()
+        newly_paid = mark_paid(paid, now)
+        record_paid(newly_paid, now)
+        check_late_payments(newly_paid)
+        stock.commit(paid)
+    expired -= paid
+    if expired:
+        unpaid = db(db.customer_order.id.belongs(expired) &
+                    (db.customer_order.paid == False)).select(db.customer_order.id)
+        for order in unpaid:
+            stock.release(order.id)
+        # The orders are kept, as the reaped ones, for the order browser,
+        # and in case a payment still arrives (see check_late_payments()).
+        db(db.customer_order.id.belongs([o.id for o in unpaid]) &
+           (db.customer_order.paid == False)).update(payment_status=EXPIRED)
+    db(db.payment_event.id.belongs([e.id for e in events])).update(processed=True)
+    db.commit()
+    return len(events)
+
+
+_apply_lock = threading.Lock()
+# The timer of the apply scheduled or running, if any, and whether events
+# were recorded while it was running.
+_apply_timer = None
+_apply_again = False
+
+
+def _start_timer():
+    # Called with the lock held.
+    global _apply_timer
+    _apply_timer = threading.Timer(WEBHOOK_BATCH_DELAY, _apply_in_background)
+    _apply_timer.daemon = True
+    _apply_timer.start()
+
+
+def _apply_in_background():
+    global _apply_timer, _apply_again
+    with _apply_lock:
+        _apply_again = False
+    # This runs in its own thread, so it needs its own db connection.
+    db._adapter.reconnect()
+    try:
+        while apply_pending_events():
+            pass
+    except Exception as e:
+        db.rollback()
+        logger.error("Could not apply the payment events: %s", e)
+    finally:
+        db._adapter.close()
+        # The timer is cleared only now, so that a single apply runs at a
+        # time in this process; events recorded after the last batch was
+        # read are applied by another round.
+        with _apply_lock:
+            if _apply_again:
+                _start_timer()
+            else:
+                _apply_timer = None
+
+
+def schedule_apply():
+    """Makes sure the recorded events are applied within WEBHOOK_BATCH_DELAY
+    seconds; events recorded in the meantime are applied together."""
+    global _apply_again
+    with _apply_lock:
+        if _apply_timer is None:
+            _start_timer()
+        else:
+            _apply_again = True
+
+
+# Replaying synthetic events.
+
+def replay(n=5000, duplicates=0.2, cleanup=True):
+    """Creates n synthetic unpaid orders, and pays them by sending signed
+    events through the webhook pipeline; a fraction of the events is sent
+    twice.  Returns, and prints, the throughput."""
+    secret = 'whsec_replay'
+    order_ids = db.customer_order.bulk_insert([
+        dict(ordered_items='[]', fulfillment=json.dumps({'synthetic': True}))
+        for _ in range(n)
+    ])
+    db.commit()
+    requests = []
+    for i, order_id in enumerate(order_ids):
+        payload = json.dumps({
+            'id': 'evt_replay_%s' % uuid.uuid4().hex,
+            'type': SESSION_COMPLETED,
+            'data': {'object': {'client_reference_id': str(order_id),
+                                'payment_status': 'paid'}},
+        }).encode('utf8')
+        requests.append((payload, sign(payload, secret)))
+        if i < n * duplicates:
+            requests.append(requests[-1])
+    t0 = time.time()
+    for payload, header in requests:
+        # Each request is committed separately, as in the webhook action.
+        if record(receive(payload, header, secret=secret)):
+            db.commit()
+    t1 = time.time()
+    while apply_pending_events():
+        pass
+    t2 = time.time()
+    stats = dict(
+        events=len(requests),
+        record_seconds=round(t1 - t0, 3),
+        apply_seconds=round(t2 - t1, 3),
+        events_per_second=round(len(requests) / max(t2 - t0, 1e-9)),
+        orders_paid=db(db.customer_order.id.belongs(order_ids) &
+                       (db.customer_order.paid == True)).count(),
+    )
+    if cleanup:
+        db(db.customer_order.id.belongs(order_ids)).delete()
+        db(db.payment_event.event_id.startswith('evt_replay_')).delete()
+        db.commit()
+        rebuild_daily_sales()
+    print(json.dumps(stats))
+    return stats